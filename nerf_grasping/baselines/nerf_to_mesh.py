@@ -1,22 +1,72 @@
+import io
+import itertools
 from pathlib import Path
-from typing import Callable, Optional, Tuple
+from typing import Callable, Optional, Tuple, Union
 from typing_extensions import Unpack
 
 import matplotlib.pyplot as plt
 import numpy as np
 import torch
+import torch.nn.functional as F
 import trimesh
+from scipy.ndimage import binary_dilation
 from skimage.measure import marching_cubes
 from nerf_grasping.grasp_utils import load_nerf_field, get_nerf_configs
 
 
-def sdf_to_mesh(
+def _query_sdf_in_chunks(
+    sdf: Callable[[torch.Tensor], float], pts: torch.Tensor, chunk_size: int
+) -> np.ndarray:
+    """Evaluates the SDF on (B, 3) points in chunks, returning a (B,) array."""
+    if pts.shape[0] == 0:
+        return np.zeros(0)
+    with torch.inference_mode():
+        return np.concatenate(
+            [
+                np.asarray(sdf(pts[i : i + chunk_size])).reshape(-1)
+                for i in range(0, pts.shape[0], chunk_size)
+            ]
+        )
+
+
+def _active_grid_points_mask(coarse_vol: np.ndarray, stride: int) -> np.ndarray:
+    """Marks the fine grid points in coarse cells the 0-level set may pass through.
+
+    A coarse cell is active if its corners change sign, or if a neighboring cell's do.
+    """
+    n_coarse_cells = coarse_vol.shape[0] - 1
+    n_fine_cells = n_coarse_cells * stride
+    corner_signs = [
+        coarse_vol[
+            dx : n_coarse_cells + dx, dy : n_coarse_cells + dy, dz : n_coarse_cells + dz
+        ]
+        > 0
+        for dx, dy, dz in itertools.product((0, 1), repeat=3)
+    ]
+    active_cells = np.any(corner_signs, axis=0) & ~np.all(corner_signs, axis=0)
+    active_cells = binary_dilation(active_cells)
+
+    # Every fine cell inside an active coarse cell, then all 8 corners of those cells
+    active_fine_cells = active_cells
+    for axis in range(3):
+        active_fine_cells = np.repeat(active_fine_cells, stride, axis=axis)
+    active_pts = np.zeros((n_fine_cells + 1,) * 3, dtype=bool)
+    for dx, dy, dz in itertools.product((0, 1), repeat=3):
+        active_pts[
+            dx : n_fine_cells + dx, dy : n_fine_cells + dy, dz : n_fine_cells + dz
+        ] |= active_fine_cells
+    return active_pts
+
+
+def sdf_to_volume(
     sdf: Callable[[torch.Tensor], float],
     npts: int = 31,
     lb: np.ndarray = -np.ones(3),
     ub: np.ndarray = np.ones(3),
-) -> Unpack[Tuple[np.ndarray, ...]]:
-    """Converts an SDF to a mesh using marching cubes.
+    chunk_size: int = 2**18,
+    coarse_stride: Optional[int] = None,
+) -> np.ndarray:
+    """Samples an SDF on the marching cubes grid.
 
     Parameters
     ----------
@@ -28,42 +78,138 @@ def sdf_to_mesh(
         Lower bound for marching cubes.
     ub : np.ndarray, default=np.ones(3)
         Upper bound for marching cubes.
+    chunk_size : int, default=2**18
+        Number of grid points passed to the SDF per call.
+    coarse_stride : Optional[int], default=None
+        If given, first evaluate the SDF on every coarse_stride-th grid point, and
+        only evaluate the full grid in coarse cells near a sign change. Elsewhere the
+        coarse values are trilinearly upsampled. (npts - 1) must be divisible by it.
+
+
+    Returns
+    -------
+    vol : np.ndarray, shape=(npts, npts, npts)
+        The SDF values on the grid.
+    """
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    # Build the grid directly on device and query it in large chunks
+    grid_1d = [torch.linspace(lb[i], ub[i], npts, device=device) for i in range(3)]
+    if coarse_stride is None:
+        pts_plot_flat = torch.stack(
+            torch.meshgrid(*grid_1d, indexing="ij"), dim=-1
+        ).reshape(-1, 3)  # (B, 3)
+        vol = _query_sdf_in_chunks(sdf, pts_plot_flat, chunk_size).reshape(
+            npts, npts, npts
+        )
+    else:
+        assert (
+            npts - 1
+        ) % coarse_stride == 0, f"npts - 1 must be divisible by {coarse_stride}"
+        coarse_grid_1d = [g[::coarse_stride] for g in grid_1d]
+        n_coarse = coarse_grid_1d[0].shape[0]
+        coarse_pts = torch.stack(
+            torch.meshgrid(*coarse_grid_1d, indexing="ij"), dim=-1
+        ).reshape(-1, 3)
+        coarse_vol = _query_sdf_in_chunks(sdf, coarse_pts, chunk_size).reshape(
+            n_coarse, n_coarse, n_coarse
+        )
+
+        # Upsampled values cannot change sign within an inactive cell; active cells
+        # then get their exact values
+        vol = F.interpolate(
+            torch.from_numpy(coarse_vol)[None, None],
+            size=(npts, npts, npts),
+            mode="trilinear",
+            align_corners=True,
+        )[0, 0].numpy()
+        if coarse_vol.min() > 0 or coarse_vol.max() < 0:
+            # No coarse cell straddles the level set, so there is nothing to refine
+            return vol
+        active_pts = _active_grid_points_mask(coarse_vol, stride=coarse_stride)
+        active_idxs = torch.from_numpy(np.stack(np.nonzero(active_pts), axis=-1)).to(
+            device
+        )
+        fine_pts = torch.stack(
+            [grid_1d[i][active_idxs[:, i]] for i in range(3)], dim=-1
+        )
+        vol[active_pts] = _query_sdf_in_chunks(sdf, fine_pts, chunk_size)
+    return vol
 
 
+def volume_to_mesh(
+    vol: np.ndarray,
+    lb: np.ndarray = -np.ones(3),
+    ub: np.ndarray = np.ones(3),
+) -> Unpack[Tuple[np.ndarray, ...]]:
+    """Runs marching cubes on the 0-level set of an SDF volume from sdf_to_volume.
+
     Returns
     -------
-    verts : np.ndarray, shape=(nverts, 3)
+    verts : np.ndarray, shape=(nverts, 3), type=float32
         The vertices of the mesh.
-    faces : np.ndarray, shape=(nfaces, 3), type=int
+    faces : np.ndarray, shape=(nfaces, 3), type=int32
         The vertex indices associated with the corners of each face.
     normals : np.ndarray, shape=(nfaces, 3)
         The surface normals associated with each face.
     """
     # running marching cubes to extract the isosurface
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-    X, Y, Z = np.mgrid[
-        lb[0] : ub[0] : npts * 1j,
-        lb[1] : ub[1] : npts * 1j,
-        lb[2] : ub[2] : npts * 1j,
-    ]
-    pts_plot = np.stack((X, Y, Z), axis=-1)  # (npts, npts, npts, 3)
-    pts_plot_flat = torch.tensor(pts_plot.reshape((-1, 3)), device=device)  # (B, 3)
-    vol = np.array(sdf(pts_plot_flat).reshape(pts_plot.shape[:-1]))
     _verts, faces, normals, _ = marching_cubes(vol, 0.0, allow_degenerate=False)
-    verts = (ub - lb) * _verts / (np.array(X.shape) - 1) + lb  # scaling verts properly
+    # scaling verts properly
+    verts = (ub - lb) * _verts / np.subtract(vol.shape, 1) + lb
+    # Contiguous float32 / int32 arrays all the way to the .obj writer
+    verts = np.ascontiguousarray(verts, dtype=np.float32)
+    faces = np.ascontiguousarray(faces, dtype=np.int32)
     return verts, faces, normals
 
 
+def sdf_to_mesh(
+    sdf: Callable[[torch.Tensor], float],
+    npts: int = 31,
+    lb: np.ndarray = -np.ones(3),
+    ub: np.ndarray = np.ones(3),
+    chunk_size: int = 2**18,
+    coarse_stride: Optional[int] = None,
+) -> Unpack[Tuple[np.ndarray, ...]]:
+    """Converts an SDF to a mesh using marching cubes.
+
+    See sdf_to_volume for the parameters and volume_to_mesh for the outputs.
+    """
+    vol = sdf_to_volume(
+        sdf,
+        npts=npts,
+        lb=lb,
+        ub=ub,
+        chunk_size=chunk_size,
+        coarse_stride=coarse_stride,
+    )
+    return volume_to_mesh(vol, lb=lb, ub=ub)
+
+
+def _write_obj(
+    path: Path, verts: np.ndarray, faces: np.ndarray, vertex_normals: np.ndarray
+) -> None:
+    """Writes a triangle mesh with per-vertex normals to a .obj file in one pass."""
+    buf = io.BytesIO()
+    np.savetxt(buf, verts, fmt="v %.8f %.8f %.8f")
+    np.savetxt(buf, vertex_normals, fmt="vn %.8f %.8f %.8f")
+    # 1-indexed, and each corner uses its vertex's normal
+    np.savetxt(buf, np.repeat(faces + 1, 2, axis=1), fmt="f %d//%d %d//%d %d//%d")
+    Path(path).write_bytes(buf.getvalue())
+
+
 def nerf_to_mesh(
     field,
     level: float,
     npts: int = 31,
-    lb: np.ndarray = -np.ones(3),
-    ub: np.ndarray = np.ones(3),
+    lb: Union[np.ndarray, Tuple[float, float, float]] = (-1.0, -1.0, -1.0),
+    ub: Union[np.ndarray, Tuple[float, float, float]] = (1.0, 1.0, 1.0),
     scale: float = 1.0,
     min_len: Optional[float] = None,
     flip_faces: bool = True,
     save_path: Optional[Path] = None,
+    coarse_stride: Optional[int] = None,
+    density_cache_path: Optional[Path] = None,
+    use_fp16_autocast: bool = False,
 ) -> None:
     """Takes a nerfstudio pipeline field and plots or saves a mesh.
 
@@ -75,9 +221,9 @@ def nerf_to_mesh(
         The density level to treat as the 0-level set.
     npts : int, default=31
         Number of points used to grid space in each dimension for marching cubes.
-    lb : np.ndarray, default=-np.ones(3)
+    lb : Union[np.ndarray, Tuple[float, float, float]], default=(-1.0, -1.0, -1.0)
         Lower bound for marching cubes.
-    ub : np.ndarray, default=np.ones(3)
+    ub : Union[np.ndarray, Tuple[float, float, float]], default=(1.0, 1.0, 1.0)
         Upper bound for marching cubes.
     scale : float, default=1.0
         The scale to apply to the mesh.
@@ -88,18 +234,54 @@ def nerf_to_mesh(
         (it appears that the faces are flipped inside out by default)
     save_path : Optional[Path], default=None
         The save path. If None, shows a plot instead.
+    coarse_stride : Optional[int], default=None
+        If given, only densely query the field near the level set (see sdf_to_mesh).
+    density_cache_path : Optional[Path], default=None
+        .npy file of grid densities. Loaded if it exists, otherwise written after
+        querying the field. The caller must key it by every argument that affects
+        the grid (and by level if coarse_stride is given).
+    use_fp16_autocast : bool, default=False
+        Whether to query the field under float16 autocast (CUDA only). The densities
+        are only compared against level, so reduced precision is enough.
     """
+    # The grid and marching cubes vertices are float32, so the bounds are too
+    lb = np.asarray(lb, dtype=np.float32)
+    ub = np.asarray(ub, dtype=np.float32)
+
     # marching cubes
-    sdf = lambda x: field.density_fn(x).cpu().detach().numpy() - level
-    verts, faces, normals = sdf_to_mesh(
-        sdf,
-        npts=npts,
-        lb=lb,
-        ub=ub,
-    )
+    if density_cache_path is not None and density_cache_path.exists():
+        print(f"Loading cached densities from {density_cache_path}")
+        vol = np.load(density_cache_path) - level
+    else:
+
+        def sdf(x: torch.Tensor) -> np.ndarray:
+            with torch.autocast(
+                device_type=x.device.type,
+                dtype=torch.float16,
+                enabled=use_fp16_autocast and x.device.type == "cuda",
+            ):
+                densities = field.density_fn(x)
+            return densities.float().cpu().detach().numpy() - level
+
+        vol = sdf_to_volume(
+            sdf,
+            npts=npts,
+            lb=lb,
+            ub=ub,
+            coarse_stride=coarse_stride,
+        )
+        if density_cache_path is not None:
+            print(f"Saving densities to {density_cache_path}")
+            density_cache_path.parent.mkdir(parents=True, exist_ok=True)
+            np.save(density_cache_path, vol + level)
+    if vol.min() > 0 or vol.max() < 0:
+        raise ValueError(
+            f"Density never crosses level={level} inside [{lb}, {ub}], nothing to mesh"
+        )
+    verts, faces, normals = volume_to_mesh(vol, lb=lb, ub=ub)
 
     if flip_faces:
-        faces = np.fliplr(faces)
+        faces = np.ascontiguousarray(np.fliplr(faces))
 
     # making a trimesh mesh
     mesh = trimesh.Trimesh(
@@ -111,6 +293,10 @@ def nerf_to_mesh(
         mask = np.zeros(len(mesh.faces), dtype=bool)
         mask[np.concatenate(cc)] = True
         mesh.update_faces(mask)
+    # Weld coincident vertices and drop those only the removed floaters used, so
+    # they are not written out
+    mesh.merge_vertices()
+    mesh.remove_unreferenced_vertices()
 
     # saving/visualizing
     if save_path is None:
@@ -124,6 +310,8 @@ def nerf_to_mesh(
         )
         ax.set_aspect("equal")
         plt.show()
+    elif Path(save_path).suffix == ".obj":
+        _write_obj(save_path, mesh.vertices, mesh.faces, mesh.vertex_normals)
     else:
         mesh.export(save_path)
 
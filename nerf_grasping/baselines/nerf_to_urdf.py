@@ -1,7 +1,8 @@
 import tyro
+import hashlib
+import re
 import pathlib
-import subprocess
-import numpy as np
+import torch
 from typing import Optional
 
 from dataclasses import dataclass
@@ -10,37 +11,29 @@ from nerf_grasping.grasp_utils import load_nerf_field
 from typing import Tuple
 
 
-@dataclass
+@dataclass(frozen=True)
 class Args:
     nerfcheckpoint_filepath: pathlib.Path
     bounding_cube_half_length: float = 0.2
     density_of_0_level_set: float = 15.0
     n_pts_each_dim_marching_cubes: int = 31
+    marching_cubes_coarse_stride: Optional[int] = None
+    fp16_density_queries: bool = False
+    # Worth it for large grids; the first chunk pays the compile time
+    compile_density_fn: bool = False
     rescale: bool = True
     min_num_edges: Optional[int] = 100
     output_dir_path: pathlib.Path = pathlib.Path(__file__).parent / "nerf_meshdata"
+    density_cache_dir: Optional[pathlib.Path] = None
+    # Extra stat calls guarding against clobbering an existing URDF (unless --force) or
+    # the mesh writer silently failing
+    strict_path_checks: bool = False
+    # Regenerate the mesh and URDF even if both already exist
+    force: bool = False
 
 
-def print_and_run(cmd: str) -> None:
-    print(cmd)
-    subprocess.run(cmd, shell=True)
-
-
-def create_urdf(
-    obj_path: pathlib.Path,
-    output_urdf_filename: str,
-    ixx: float = 0.1,
-    iyy: float = 0.1,
-    izz: float = 0.1,
-) -> pathlib.Path:
-    assert obj_path.exists(), f"{obj_path} does not exist"
-    assert output_urdf_filename.endswith(
-        ".urdf"
-    ), f"{output_urdf_filename} does not end with .urdf"
-    output_folder = obj_path.parent
-    obj_filename = obj_path.name
-
-    urdf_content = f"""<robot name="root">
+# Rendered with format_map; the only braces in it are the placeholders
+_URDF_TEMPLATE = """<robot name="root">
   <link name="base_link">
     <inertial>
       <origin xyz="0 0 0" rpy="0 0 0"/>
@@ -64,31 +57,65 @@ def create_urdf(
   </link>
 </robot>"""
 
+
+def create_urdf(
+    obj_path: pathlib.Path,
+    output_urdf_filename: str,
+    ixx: float = 0.1,
+    iyy: float = 0.1,
+    izz: float = 0.1,
+    strict: bool = False,
+    overwrite: bool = False,
+) -> pathlib.Path:
+    assert output_urdf_filename.endswith(
+        ".urdf"
+    ), f"{output_urdf_filename} does not end with .urdf"
+    output_folder = obj_path.parent
     output_urdf_path = output_folder / output_urdf_filename
-    assert not output_urdf_path.exists(), f"{output_urdf_path} already exists"
+    if strict:
+        assert obj_path.exists(), f"{obj_path} does not exist"
+        assert (
+            overwrite or not output_urdf_path.exists()
+        ), f"{output_urdf_path} already exists"
+
+    urdf_content = _URDF_TEMPLATE.format_map(
+        dict(obj_filename=obj_path.name, ixx=ixx, iyy=iyy, izz=izz)
+    )
     with open(output_urdf_path, "w") as urdf_file:
         urdf_file.write(urdf_content)
     return output_urdf_path
 
 
-def parse_object_code_and_scale(object_code_and_scale_str: str) -> Tuple[str, float]:
-    keyword = "_0_"
-    idx = object_code_and_scale_str.rfind(keyword)
-    object_code = object_code_and_scale_str[:idx]
-
-    idx_offset_for_scale = keyword.index("0")
-    object_scale = float(
-        object_code_and_scale_str[idx + idx_offset_for_scale :].replace("_", ".")
+def get_density_cache_key(args: Args) -> str:
+    # Everything that changes the sampled densities; the level only matters when coarse
+    # sampling uses it to pick which cells to query
+    key_fields = (
+        str(args.nerfcheckpoint_filepath.resolve()),
+        args.bounding_cube_half_length,
+        args.n_pts_each_dim_marching_cubes,
+        args.marching_cubes_coarse_stride,
+        args.fp16_density_queries,
+        args.density_of_0_level_set
+        if args.marching_cubes_coarse_stride is not None
+        else None,
     )
-    return object_code, object_scale
+    return hashlib.sha1(repr(key_fields).encode()).hexdigest()
 
 
-def main() -> None:
-    args = tyro.cli(Args)
-    print("=" * 80)
-    print(f"{pathlib.Path(__file__).name} args: {args}")
-    print("=" * 80 + "\n")
+# Greedy so the code is everything before the last "_0_"
+_OBJECT_CODE_AND_SCALE_PATTERN = re.compile(r"^(.*)_0_(\d+)$")
 
+
+def parse_object_code_and_scale(object_code_and_scale_str: str) -> Tuple[str, float]:
+    match = _OBJECT_CODE_AND_SCALE_PATTERN.match(object_code_and_scale_str)
+    assert (
+        match is not None
+    ), f"{object_code_and_scale_str} does not end with _0_<scale digits>"
+    object_code, object_scale_digits = match.groups()
+    return object_code, float(f"0.{object_scale_digits}")
+
+
+def nerf_to_urdf(args: Args) -> Tuple[pathlib.Path, pathlib.Path]:
     assert (
         args.nerfcheckpoint_filepath.exists()
     ), f"{args.nerfcheckpoint_filepath} does not exist"
@@ -103,20 +130,45 @@ def main() -> None:
     object_code_and_scale = args.nerfcheckpoint_filepath.parent.parent.parent.name
     object_code, object_scale = parse_object_code_and_scale(object_code_and_scale)
 
-    nerf_field = load_nerf_field(args.nerfcheckpoint_filepath)
-    lb = -args.bounding_cube_half_length * np.ones(3)
-    ub = args.bounding_cube_half_length * np.ones(3)
-
     # Should match existing meshdata folder structure
     # <output_dir_path>
     # └── <object_code>
     #     └── coacd
     #         ├── coacd.urdf
     #         └── decomposed.obj
+    # Checked before loading the NeRF so repeat runs skip all of the work
     output_folder = args.output_dir_path / object_code / "coacd"
-    output_folder.mkdir(exist_ok=False, parents=True)
-
     obj_path = output_folder / "decomposed.obj"
+    urdf_path = output_folder / "coacd.urdf"
+    if not args.force and obj_path.exists() and urdf_path.exists():
+        print(f"Skipping, {urdf_path} and {obj_path} already exist")
+        return urdf_path, obj_path
+    if not args.force and (obj_path.exists() or urdf_path.exists()):
+        # Left by an interrupted run, since the URDF is written after the mesh
+        print(f"Overwriting incomplete output in {output_folder}")
+    output_folder.mkdir(exist_ok=True, parents=True)
+
+    density_cache_path = (
+        args.density_cache_dir / f"{get_density_cache_key(args)}.npy"
+        if args.density_cache_dir is not None
+        else None
+    )
+    # The field is only queried on a cache miss
+    nerf_field = (
+        load_nerf_field(args.nerfcheckpoint_filepath)
+        if density_cache_path is None or not density_cache_path.exists()
+        else None
+    )
+    if nerf_field is not None:
+        # Only queried for densities, so skip dropout and autograd bookkeeping
+        nerf_field.eval()
+        nerf_field.requires_grad_(False)
+        if args.compile_density_fn:
+            nerf_field.density_fn = torch.compile(nerf_field.density_fn)
+    half_length = args.bounding_cube_half_length
+    lb = (-half_length, -half_length, -half_length)
+    ub = (half_length, half_length, half_length)
+
     scale = 1.0 / object_scale if args.rescale else 1.0
     nerf_to_mesh(
         nerf_field,
@@ -127,13 +179,32 @@ def main() -> None:
         scale=scale,
         min_len=args.min_num_edges,
         save_path=obj_path,
+        coarse_stride=args.marching_cubes_coarse_stride,
+        density_cache_path=density_cache_path,
+        use_fp16_autocast=args.fp16_density_queries,
     )
 
-    urdf_path = create_urdf(obj_path=obj_path, output_urdf_filename="coacd.urdf")
+    urdf_path = create_urdf(
+        obj_path=obj_path,
+        output_urdf_filename=urdf_path.name,
+        strict=args.strict_path_checks,
+        overwrite=args.force,
+    )
 
-    assert urdf_path.exists(), f"{urdf_path} does not exist"
-    assert obj_path.exists(), f"{obj_path} does not exist"
+    if args.strict_path_checks:
+        assert urdf_path.exists(), f"{urdf_path} does not exist"
+        assert obj_path.exists(), f"{obj_path} does not exist"
     print(f"Created {urdf_path} and {obj_path}")
+    return urdf_path, obj_path
+
+
+def main() -> None:
+    args = tyro.cli(Args)
+    print("=" * 80)
+    print(f"{pathlib.Path(__file__).name} args: {args}")
+    print("=" * 80 + "\n")
+
+    nerf_to_urdf(args)
 
 
 if __name__ == "__main__":
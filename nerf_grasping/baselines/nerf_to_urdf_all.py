@@ -1,27 +1,51 @@
 import tyro
+import os
 import pathlib
-import subprocess
+import traceback
+import multiprocessing
+import torch
+from concurrent.futures import ProcessPoolExecutor
 from typing import Optional
 from tqdm import tqdm
 
 from dataclasses import dataclass
+from nerf_grasping.baselines.nerf_to_urdf import Args as NerfToUrdfArgs, nerf_to_urdf
 from nerf_grasping.grasp_utils import get_nerf_configs
 
 
-@dataclass
+@dataclass(frozen=True)
 class Args:
     nerfcheckpoints_path: pathlib.Path
     bounding_cube_half_length: float = 0.2
     density_of_0_level_set: float = 15.0
     n_pts_each_dim_marching_cubes: int = 31
+    marching_cubes_coarse_stride: Optional[int] = None
+    fp16_density_queries: bool = False
+    compile_density_fn: bool = False
     rescale: bool = True
     min_num_edges: Optional[int] = 100
     output_dir_path: pathlib.Path = pathlib.Path(__file__).parent / "nerf_meshdata"
+    density_cache_dir: Optional[pathlib.Path] = None
+    strict_path_checks: bool = False
+    force: bool = False
+    num_workers: int = 1
 
 
-def print_and_run(cmd: str) -> None:
-    print(cmd)
-    subprocess.run(cmd, shell=True)
+def _init_worker(gpu_ids: multiprocessing.Queue) -> None:
+    # Pin each worker to one of the parent's visible GPUs before it initializes CUDA
+    gpu_id = gpu_ids.get()
+    if gpu_id is not None:
+        os.environ["CUDA_VISIBLE_DEVICES"] = gpu_id
+
+
+def _nerf_to_urdf_or_print_error(nerf_to_urdf_args: NerfToUrdfArgs) -> None:
+    print(f"nerf_to_urdf args: {nerf_to_urdf_args}")
+    try:
+        nerf_to_urdf(nerf_to_urdf_args)
+    except Exception as e:
+        # Like the old per-object subprocess, one failure does not stop the rest
+        print(f"Failed on {nerf_to_urdf_args.nerfcheckpoint_filepath}: {e}")
+        print(traceback.format_exc())
 
 
 def main() -> None:
@@ -34,20 +58,62 @@ def main() -> None:
         args.nerfcheckpoints_path.exists()
     ), f"{args.nerfcheckpoints_path} does not exist"
     nerf_configs = get_nerf_configs(args.nerfcheckpoints_path)
-    for nerf_config in tqdm(nerf_configs):
-        command = " ".join(
-            [
-                "python nerf_grasping/baselines/nerf_to_urdf.py",
-                f"--nerfcheckpoint-filepath {nerf_config}",
-                f"--bounding-cube-half-length {args.bounding_cube_half_length}",
-                f"--density-of-0-level-set {args.density_of_0_level_set}",
-                f"--n-pts-each-dim-marching-cubes {args.n_pts_each_dim_marching_cubes}",
-                "--rescale" if args.rescale else "--no-rescale",
-                f"--min-num-edges {args.min_num_edges}",
-                f"--output-dir-path {str(args.output_dir_path)}",
-            ]
+    all_nerf_to_urdf_args = [
+        NerfToUrdfArgs(
+            nerfcheckpoint_filepath=nerf_config,
+            bounding_cube_half_length=args.bounding_cube_half_length,
+            density_of_0_level_set=args.density_of_0_level_set,
+            n_pts_each_dim_marching_cubes=args.n_pts_each_dim_marching_cubes,
+            marching_cubes_coarse_stride=args.marching_cubes_coarse_stride,
+            fp16_density_queries=args.fp16_density_queries,
+            compile_density_fn=args.compile_density_fn,
+            rescale=args.rescale,
+            min_num_edges=args.min_num_edges,
+            output_dir_path=args.output_dir_path,
+            density_cache_dir=args.density_cache_dir,
+            strict_path_checks=args.strict_path_checks,
+            force=args.force,
+        )
+        for nerf_config in nerf_configs
+    ]
+
+    if args.num_workers <= 1:
+        # Run each conversion in this process, so torch import, CUDA init and kernel
+        # warmup are paid once for the whole dataset instead of once per object
+        for nerf_to_urdf_args in tqdm(all_nerf_to_urdf_args):
+            _nerf_to_urdf_or_print_error(nerf_to_urdf_args)
+    else:
+        # Long-lived workers, assigned to GPUs round-robin, so one worker's marching
+        # cubes and file writes overlap with another's NeRF queries
+        # Indices into torch's device list are relative to the parent's
+        # CUDA_VISIBLE_DEVICES, so hand out entries of that list instead
+        parent_visible_devices = os.environ.get("CUDA_VISIBLE_DEVICES")
+        visible_devices = (
+            [device.strip() for device in parent_visible_devices.split(",")]
+            if parent_visible_devices is not None
+            else [str(i) for i in range(torch.cuda.device_count())]
         )
-        print_and_run(command)
+        visible_devices = visible_devices[: torch.cuda.device_count()]
+        mp_context = multiprocessing.get_context("spawn")
+        gpu_ids = mp_context.Queue()
+        for worker_idx in range(args.num_workers):
+            gpu_ids.put(
+                visible_devices[worker_idx % len(visible_devices)]
+                if len(visible_devices) > 0
+                else None
+            )
+        with ProcessPoolExecutor(
+            max_workers=args.num_workers,
+            mp_context=mp_context,
+            initializer=_init_worker,
+            initargs=(gpu_ids,),
+        ) as executor:
+            list(
+                tqdm(
+                    executor.map(_nerf_to_urdf_or_print_error, all_nerf_to_urdf_args),
+                    total=len(all_nerf_to_urdf_args),
+                )
+            )
 
 
 if __name__ == "__main__":
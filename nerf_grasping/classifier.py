@@ -87,6 +87,7 @@ class CNN_3D_XYZ_Classifier(Classifier):
         mlp_hidden_layers: Iterable[int],
         n_fingers: int,
         n_tasks: int,
+        grad_checkpointing: bool = False,
     ) -> None:
         super().__init__()
         self.model = CNN_3D_Model(
@@ -95,6 +96,7 @@ class CNN_3D_XYZ_Classifier(Classifier):
             mlp_hidden_layers=mlp_hidden_layers,
             n_fingers=n_fingers,
             n_tasks=n_tasks,
+            grad_checkpointing=grad_checkpointing,
         )
 
     def forward(self, batch_data_input: BatchDataInput) -> torch.Tensor:
@@ -1,5 +1,6 @@
 from __future__ import annotations
 from dataclasses import dataclass, field
+import itertools
 from typing import Optional, Literal, Tuple, List, Union
 from nerf_grasping.config.fingertip_config import UnionFingertipConfig
 from nerf_grasping.classifier import (
@@ -94,12 +95,15 @@ class ClassifierDataLoaderConfig:
     pin_memory: bool = True
     """Flag to pin memory for the dataloader."""
 
+    persistent_workers: bool = True
+    """Flag to keep dataloader workers (and their open HDF5 files) alive across epochs."""
+
+    prefetch_factor: int = 4
+    """Number of batches loaded in advance by each worker."""
+
     load_nerf_grid_inputs_in_ram: bool = False
     """Flag to load the nerf grid inputs in RAM -- otherwise load on the fly."""
 
-    load_grasp_labels_in_ram: bool = False
-    """Flag to load the grasp successes in RAM -- otherwise load on the fly."""
-
     load_grasp_transforms_in_ram: bool = False
     """Flag to load the grasp transforms in RAM -- otherwise load on the fly."""
 
@@ -156,6 +160,12 @@ class ClassifierTrainingConfig:
     save_checkpoint_on_epoch_0: bool = False
     """Flag to save checkpoint on epoch 0."""
 
+    use_bf16_autocast: bool = False
+    """Flag to run the forward pass under bfloat16 autocast (no grad scaling needed)."""
+
+    compile_model: bool = False
+    """Flag to torch.compile the classifier's inner model forward."""
+
     loss_fn: Literal[
         "cross_entropy",
         "l1",
@@ -232,18 +242,24 @@ class CheckpointWorkspaceConfig:
         checkpoint_dir: Optional[pathlib.Path],
     ) -> Optional[pathlib.Path]:
         """Path to the latest checkpoint in a directory."""
-        checkpoint_filepaths = CheckpointWorkspaceConfig.checkpoint_paths(
-            checkpoint_dir
+        # Single max-by-mtime pass instead of sorting every checkpoint path
+        latest_checkpoint_filepath = (
+            max(
+                itertools.chain(
+                    checkpoint_dir.glob("*.pt"), checkpoint_dir.glob("*.pth")
+                ),
+                key=lambda x: x.stat().st_mtime,
+                default=None,
+            )
+            if checkpoint_dir is not None
+            else None
         )
-        if len(checkpoint_filepaths) == 0:
+        if latest_checkpoint_filepath is None:
             print("No checkpoint found")
             return None
 
-        if len(checkpoint_filepaths) > 1:
-            print(
-                f"Found multiple checkpoints: {checkpoint_filepaths}. Returning most recent one."
-            )
-        return checkpoint_filepaths[-1]
+        print(f"Returning most recent checkpoint: {latest_checkpoint_filepath}")
+        return latest_checkpoint_filepath
 
 
 @dataclass(frozen=True)
@@ -272,6 +288,9 @@ class CNN_3D_XYZ_ModelConfig(ClassifierModelConfig):
     n_fingers: int = 4
     """Number of fingers."""
 
+    grad_checkpointing: bool = False
+    """Flag to recompute conv activations in backward to reduce peak memory."""
+
     def input_shape_from_fingertip_config(self, fingertip_config: UnionFingertipConfig):
         return [
             4,
@@ -294,6 +313,7 @@ class CNN_3D_XYZ_ModelConfig(ClassifierModelConfig):
             n_tasks=n_tasks,
             conv_channels=self.conv_channels,
             mlp_hidden_layers=self.mlp_hidden_layers,
+            grad_checkpointing=self.grad_checkpointing,
         )
 
 
@@ -519,6 +539,8 @@ class ClassifierConfig:
 
     random_seed: int = 42
 
+    visualize_model: bool = False
+
     def __post_init__(self):
         """
         If a nerfdata config path was passed, load that config object.
@@ -45,6 +45,9 @@ class BaseNerfDataConfig:
     plot_all_high_density_points: bool = True
     plot_alphas_each_finger_1D: bool = True
     plot_alpha_images_each_finger: bool = True
+    # float16 halves disk I/O and RAM, but values above 65504 become inf, and nerfacto
+    # densities can exceed that
+    store_half_precision: bool = False
 
     fingertip_config: Optional[UnionFingertipConfig] = EvenlySpacedFingertipConfig()
 
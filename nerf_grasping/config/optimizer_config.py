@@ -1,14 +1,15 @@
+import functools
 from dataclasses import dataclass
 import tyro
 
 
-@dataclass
+@dataclass(frozen=True)
 class BaseOptimizerConfig:
     num_grasps: int = 20
     num_steps: int = 30
 
 
-@dataclass
+@dataclass(frozen=True)
 class SGDOptimizerConfig(BaseOptimizerConfig):
     num_steps: int = 200
     finger_lr: float = 1e-4
@@ -19,7 +20,7 @@ class SGDOptimizerConfig(BaseOptimizerConfig):
     opt_grasp_dirs: bool = True
 
 
-@dataclass
+@dataclass(frozen=True)
 class CEMOptimizerConfig(BaseOptimizerConfig):
     num_steps: int = 30
     num_samples: int = 5
@@ -27,9 +28,18 @@ class CEMOptimizerConfig(BaseOptimizerConfig):
     min_cov_std: float = 1e-2
 
 
-UnionGraspOptimizerConfig = tyro.extras.subcommand_type_from_defaults(
-    {
-        "cem": CEMOptimizerConfig(),
-        "sgd": SGDOptimizerConfig(),
-    }
-)
+@functools.lru_cache(maxsize=None)
+def _make_union_grasp_optimizer_config():
+    return tyro.extras.subcommand_type_from_defaults(
+        {
+            "cem": CEMOptimizerConfig(),
+            "sgd": SGDOptimizerConfig(),
+        }
+    )
+
+
+def __getattr__(name: str):
+    # Build UnionGraspOptimizerConfig on first access rather than on every import
+    if name == "UnionGraspOptimizerConfig":
+        return _make_union_grasp_optimizer_config()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -1,5 +1,7 @@
+import functools
 import os
-from typing import Any, Dict, List, Tuple
+import re
+from typing import Any, Dict, List, Optional, Tuple
 import numpy as np
 import torch
 import trimesh
@@ -8,7 +10,6 @@ import pypose as pp
 import plotly.graph_objects as go
 import nerf_grasping
 import nerfstudio
-from matplotlib import pyplot as plt
 from nerf_grasping.grasp_utils import (
     get_ray_samples_helper,
     get_ray_origins_finger_frame_helper,
@@ -40,20 +41,34 @@ def get_object_code(cfg_path: pathlib.Path) -> str:
     return object_code
 
 
+# Greedy so the code is everything before the last "_0_"
+_OBJECT_CODE_AND_SCALE_PATTERN = re.compile(r"^(.*)_0_(\d+)$")
+
+
 def parse_object_code_and_scale(
     object_code_and_scale_str: str,
 ) -> Tuple[str, float]:
     # Input: sem-Gun-4745991e7c0c7966a93f1ea6ebdeec6f_0_10
     # Output: sem-Gun-4745991e7c0c7966a93f1ea6ebdeec6f, 0.10
-    keyword = "_0_"
-    idx = object_code_and_scale_str.rfind(keyword)
-    object_code = object_code_and_scale_str[:idx]
+    match = _OBJECT_CODE_AND_SCALE_PATTERN.match(object_code_and_scale_str)
+    assert (
+        match is not None
+    ), f"{object_code_and_scale_str} does not end with _0_<scale digits>"
+    object_code, object_scale_digits = match.groups()
+    return object_code, float(f"0.{object_scale_digits}")
 
-    idx_offset_for_scale = keyword.index("0")
-    object_scale = float(
-        object_code_and_scale_str[idx + idx_offset_for_scale :].replace("_", ".")
-    )
-    return object_code, object_scale
+
+@functools.lru_cache(maxsize=256)
+def _load_scaled_mesh(mesh_path: pathlib.Path, object_scale: float) -> trimesh.Trimesh:
+    mesh = trimesh.load(mesh_path, force="mesh")
+    mesh.apply_transform(trimesh.transformations.scale_matrix(object_scale))
+    return mesh
+
+
+def load_scaled_mesh(mesh_path: pathlib.Path, object_scale: float) -> trimesh.Trimesh:
+    # Many visualized grasps share an object, so cache the load + scale
+    # Return a copy so callers can apply_transform in place without touching the cache
+    return _load_scaled_mesh(mesh_path, object_scale).copy()
 
 
 def get_scene_dict() -> Dict[str, Any]:
@@ -107,18 +122,23 @@ def plot_mesh_and_transforms(
 
     # Add the scatter plot to a figure and display it
     fig = plot_mesh(mesh)
+
+    # Homogeneous origin, x, y, z axis endpoints as columns, transformed for all
+    # fingers with one batched matmul: (num_fingers, 4, 4) @ (4, 4)
+    length = 0.02
+    axis_points = np.array(
+        [
+            [0, length, 0, 0],
+            [0, 0, length, 0],
+            [0, 0, 0, length],
+            [1, 1, 1, 1],
+        ]
+    )
+    transformed_axis_points = np.stack(transforms, axis=0) @ axis_points
     for finger_idx in range(num_fingers):
-        transform = transforms[finger_idx]
-        length = 0.02
-        origin = np.array([0, 0, 0])
-        x_axis = np.array([length, 0, 0])
-        y_axis = np.array([0, length, 0])
-        z_axis = np.array([0, 0, length])
-
-        new_origin = transform @ np.concatenate([origin, [1]])
-        new_x_axis = transform @ np.concatenate([x_axis, [1]])
-        new_y_axis = transform @ np.concatenate([y_axis, [1]])
-        new_z_axis = transform @ np.concatenate([z_axis, [1]])
+        new_origin, new_x_axis, new_y_axis, new_z_axis = transformed_axis_points[
+            finger_idx
+        ].T
         x_plot = go.Scatter3d(
             x=[new_origin[0], new_x_axis[0]],
             y=[new_origin[1], new_x_axis[1]],
@@ -170,6 +190,7 @@ def plot_mesh_and_query_points(
     query_points_colors_list: List[np.ndarray],
     num_fingers: int,
     title: str = "Query Points",
+    keep_top_fraction: Optional[float] = None,
 ) -> go.Figure:
     # Shape checks
     assert (
@@ -196,6 +217,16 @@ def plot_mesh_and_query_points(
         assert query_points.shape == (num_pts, 3)
         assert query_points_colors.shape == (num_pts,)
 
+        # Scatter3d gets very slow with 1e5+ points, so optionally only keep the
+        # highest-density ones (low-density points carry little visual information)
+        if keep_top_fraction is not None:
+            assert 0 < keep_top_fraction <= 1, keep_top_fraction
+            keep = query_points_colors >= np.quantile(
+                query_points_colors, 1 - keep_top_fraction
+            )
+            query_points = query_points[keep]
+            query_points_colors = query_points_colors[keep]
+
         query_point_plot = go.Scatter3d(
             x=query_points[:, 0],
             y=query_points[:, 1],
@@ -701,9 +701,9 @@ class HandModel:
             1, 2
         ) + self.global_translation.unsqueeze(1)
         dis = (points.unsqueeze(1) - points.unsqueeze(2) + 1e-13).square().sum(3).sqrt()
-        dis = torch.where(dis < 1e-6, 1e6 * torch.ones_like(dis), dis)
-        dis = 0.02 - dis
-        E_spen = torch.where(dis > 0, dis, torch.zeros_like(dis))
+        # masked_fill / relu instead of torch.where against full-size ones_like / zeros_like temporaries
+        dis = dis.masked_fill(dis < 1e-6, 1e6)
+        E_spen = torch.relu(0.02 - dis)
         return E_spen.sum((1, 2))
 
     def cal_joint_limit_energy(self):
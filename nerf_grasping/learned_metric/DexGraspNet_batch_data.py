@@ -5,9 +5,6 @@ import pypose as pp
 import torch
 from typing import List, Optional, Union
 import numpy as np
-from nerf_grasping.grasp_utils import (
-    get_ray_samples,
-)
 from nerf_grasping.grasp_utils import (
     get_ray_origins_finger_frame,
 )
@@ -26,6 +23,47 @@ def get_ray_origins_finger_frame_cached(cfg: BaseFingertipConfig) -> torch.Tenso
     return ray_origins_finger_frame
 
 
+@functools.lru_cache()
+def get_query_points_finger_frame_cached(cfg: BaseFingertipConfig) -> torch.Tensor:
+    # Same points as get_ray_samples(...).frustums.get_positions() with an identity transform:
+    # ray origins on the z=0 plane, marched along +z
+    ray_origins_finger_frame = get_ray_origins_finger_frame_cached(cfg)
+    sample_dists = torch.linspace(0.0, cfg.grasp_depth_mm / 1000.0, steps=cfg.num_pts_z)
+    query_points_finger_frame = ray_origins_finger_frame.unsqueeze(-2).repeat(
+        1, 1, cfg.num_pts_z, 1
+    )
+    query_points_finger_frame[..., 2] += sample_dists
+    assert query_points_finger_frame.shape == (
+        cfg.num_pts_x,
+        cfg.num_pts_y,
+        cfg.num_pts_z,
+        NUM_XYZ,
+    )
+    return query_points_finger_frame
+
+
+def transform_query_points(
+    grasp_transforms_matrix: torch.Tensor, query_points_finger_frame: torch.Tensor
+) -> torch.Tensor:
+    # Pure-tensor (torch.compile friendly) equivalent of building RaySamples and calling
+    # frustums.get_positions(): R @ p + t for every finger, written directly in
+    # (B, n_fingers, 3, X, Y, Z) layout so no permute copy is needed afterwards
+    rotations = grasp_transforms_matrix[..., :3, :3]
+    translations = grasp_transforms_matrix[..., :3, 3]
+    return (
+        torch.einsum("bfij,xyzj->bfixyz", rotations, query_points_finger_frame)
+        + translations[..., None, None, None]
+    )
+
+
+def pin_memory_keep_ltype(tensor: torch.Tensor) -> torch.Tensor:
+    # pypose only keeps a LieTensor's ltype for the functions it handles, and pin_memory is not
+    # one of them, so pin the raw tensor and rewrap it
+    if isinstance(tensor, pp.LieTensor):
+        return pp.LieTensor(tensor.tensor().pin_memory(), ltype=tensor.ltype)
+    return tensor.pin_memory()
+
+
 class ConditioningType(Enum):
     """Enum for conditioning type."""
 
@@ -54,21 +92,49 @@ class BatchDataInput:
     random_rotate_transform: Optional[pp.LieTensor] = None
     nerf_density_threshold_value: Optional[float] = None
 
-    def to(self, device) -> BatchDataInput:
-        self.nerf_densities = self.nerf_densities.to(device)
-        self.grasp_transforms = self.grasp_transforms.to(device)
+    def to(self, device, non_blocking: bool = False) -> BatchDataInput:
+        self.nerf_densities = self.nerf_densities.to(
+            device, non_blocking=non_blocking
+        )
+        self.grasp_transforms = self.grasp_transforms.to(
+            device, non_blocking=non_blocking
+        )
+        self.random_rotate_transform = (
+            self.random_rotate_transform.to(device=device, non_blocking=non_blocking)
+            if self.random_rotate_transform is not None
+            else None
+        )
+        self.grasp_configs = self.grasp_configs.to(device, non_blocking=non_blocking)
+        return self
+
+    def pin_memory(self) -> BatchDataInput:
+        # Called by the DataLoader pin_memory thread, which does not descend into dataclasses.
+        self.nerf_densities = self.nerf_densities.pin_memory()
+        self.grasp_transforms = pin_memory_keep_ltype(self.grasp_transforms)
         self.random_rotate_transform = (
-            self.random_rotate_transform.to(device=device)
+            pin_memory_keep_ltype(self.random_rotate_transform)
             if self.random_rotate_transform is not None
             else None
         )
-        self.grasp_configs = self.grasp_configs.to(device)
+        self.grasp_configs = self.grasp_configs.pin_memory()
         return self
 
+    def record_stream(self, stream: torch.cuda.Stream) -> None:
+        self.nerf_densities.record_stream(stream)
+        # Record the raw tensors rather than relying on pypose's LieTensor dispatch
+        self.grasp_transforms.tensor().record_stream(stream)
+        if self.random_rotate_transform is not None:
+            self.random_rotate_transform.tensor().record_stream(stream)
+        self.grasp_configs.record_stream(stream)
+
     @property
     def nerf_alphas(self) -> torch.Tensor:
+        return self._nerf_alphas_helper()
+
+    def _nerf_alphas_helper(self, out: Optional[torch.Tensor] = None) -> torch.Tensor:
         # alpha = 1 - exp(-delta * sigma)
         #       = probability of collision within this segment starting from beginning of segment
+        # If out is given, alphas are written into it in place (no intermediate allocations)
         delta = (
             self.fingertip_config.grasp_depth_mm
             / (self.fingertip_config.num_pts_z - 1)
@@ -76,16 +142,18 @@ class BatchDataInput:
         )
         if isinstance(self.fingertip_config, EvenlySpacedFingertipConfig):
             assert delta == self.fingertip_config.distance_between_pts_mm / 1000
-        alphas = 1.0 - torch.exp(-delta * self.nerf_densities)
 
         if self.nerf_density_threshold_value is not None:
-            alphas = torch.where(
-                self.nerf_densities > self.nerf_density_threshold_value,
-                torch.ones_like(alphas),
-                torch.zeros_like(alphas),
-            )
+            # Single comparison + cast instead of torch.where with two full-size temporaries
+            alphas = self.nerf_densities > self.nerf_density_threshold_value
+            if out is None:
+                return alphas.to(self.nerf_densities.dtype)
+            return out.copy_(alphas)
 
-        return alphas
+        # -expm1(-x) == 1 - exp(-x) in one kernel (and more accurate for small delta * sigma)
+        if out is None:
+            return -torch.expm1(-delta * self.nerf_densities)
+        return torch.mul(self.nerf_densities, -delta, out=out).expm1_().neg_()
 
     @property
     def coords(self) -> torch.Tensor:
@@ -126,18 +194,24 @@ class BatchDataInput:
 
         # Apply random rotation to grasp config.
         # NOTE: hardcodes grasp_configs ordering
-        wrist_pose = pp.SE3(self.grasp_configs[..., :7])
+        wrist_pose = self.grasp_configs[..., :7]
         joint_angles = self.grasp_configs[..., 7:23]
-        grasp_orientations = pp.SO3(self.grasp_configs[..., 23:])
+        grasp_orientations = self.grasp_configs[..., 23:]
 
+        # Rotate wrist poses and grasp orientations with a single SE(3) product by
+        # treating the orientations as poses with zero translation.
         # Unsqueeze because we're applying the same (single) random rotation to all fingers.
-        wrist_pose = self.random_rotate_transform.unsqueeze(1) @ wrist_pose
-        grasp_orientations = (
-            self.random_rotate_transform.rotation().unsqueeze(1) @ grasp_orientations
+        n_fingers = self.grasp_configs.shape[1]
+        grasp_orientation_poses = torch.cat(
+            (torch.zeros_like(grasp_orientations[..., :3]), grasp_orientations), dim=-1
         )
+        stacked_poses = pp.SE3(torch.cat((wrist_pose, grasp_orientation_poses), dim=1))
+        stacked_poses = (self.random_rotate_transform.unsqueeze(1) @ stacked_poses).data
+        wrist_pose = stacked_poses[:, :n_fingers]
+        grasp_orientations = stacked_poses[:, n_fingers:, 3:]
 
         return_value = torch.cat(
-            (wrist_pose.data, joint_angles, grasp_orientations.data), axis=-1
+            (wrist_pose, joint_angles, grasp_orientations), axis=-1
         )
         assert (
             return_value.shape
@@ -164,27 +238,17 @@ class BatchDataInput:
             self.batch_size,
             self.fingertip_config.n_fingers,
         )
-        ray_origins_finger_frame = get_ray_origins_finger_frame_cached(
+        query_points_finger_frame = get_query_points_finger_frame_cached(
             self.fingertip_config
         )
 
-        all_query_points = get_ray_samples(
-            ray_origins_finger_frame.to(
+        all_query_points = transform_query_points(
+            grasp_transforms_matrix=grasp_transforms.matrix(),
+            query_points_finger_frame=query_points_finger_frame.to(
                 device=grasp_transforms.device, dtype=grasp_transforms.dtype
             ),
-            grasp_transforms,
-            self.fingertip_config,
-        ).frustums.get_positions()
-
-        assert all_query_points.shape == (
-            self.batch_size,
-            self.fingertip_config.n_fingers,
-            self.fingertip_config.num_pts_x,
-            self.fingertip_config.num_pts_y,
-            self.fingertip_config.num_pts_z,
-            NUM_XYZ,
         )
-        all_query_points = all_query_points.permute(0, 1, 5, 2, 3, 4)
+
         assert all_query_points.shape == (
             self.batch_size,
             self.fingertip_config.n_fingers,
@@ -204,21 +268,24 @@ class BatchDataInput:
             self.fingertip_config.num_pts_y,
             self.fingertip_config.num_pts_z,
         )
-        reshaped_nerf_alphas = self.nerf_alphas.reshape(
-            self.batch_size,
-            self.fingertip_config.n_fingers,
-            1,
-            self.fingertip_config.num_pts_x,
-            self.fingertip_config.num_pts_y,
-            self.fingertip_config.num_pts_z,
-        )
-        return_value = torch.cat(
-            [
-                reshaped_nerf_alphas,
-                coords,
-            ],
-            dim=2,
-        )
+        # Preallocate and fill each channel in place rather than materializing
+        # the alphas separately and torch.cat-ing them with the coords
+        # Channels are stored last (permuted view) so the per-finger grids are already
+        # channels_last_3d for the 3D conv
+        return_value = torch.empty(
+            (
+                self.batch_size,
+                self.fingertip_config.n_fingers,
+                self.fingertip_config.num_pts_x,
+                self.fingertip_config.num_pts_y,
+                self.fingertip_config.num_pts_z,
+                NUM_XYZ + 1,
+            ),
+            dtype=coords.dtype,
+            device=coords.device,
+        ).permute(0, 1, 5, 2, 3, 4)
+        self._nerf_alphas_helper(out=return_value[:, :, 0])
+        return_value[:, :, 1:] = coords
         assert return_value.shape == (
             self.batch_size,
             self.fingertip_config.n_fingers,
@@ -247,17 +314,40 @@ class DepthImageBatchDataInput:
     random_rotate_transform: Optional[pp.LieTensor] = None
     nerf_density_threshold_value: Optional[float] = None
 
-    def to(self, device) -> DepthImageBatchDataInput:
-        self.depth_uncertainty_images = self.depth_uncertainty_images.to(device)
-        self.grasp_transforms = self.grasp_transforms.to(device)
+    def to(self, device, non_blocking: bool = False) -> DepthImageBatchDataInput:
+        self.depth_uncertainty_images = self.depth_uncertainty_images.to(
+            device, non_blocking=non_blocking
+        )
+        self.grasp_transforms = self.grasp_transforms.to(
+            device, non_blocking=non_blocking
+        )
         self.random_rotate_transform = (
-            self.random_rotate_transform.to(device=device)
+            self.random_rotate_transform.to(device=device, non_blocking=non_blocking)
             if self.random_rotate_transform is not None
             else None
         )
-        self.grasp_configs = self.grasp_configs.to(device)
+        self.grasp_configs = self.grasp_configs.to(device, non_blocking=non_blocking)
         return self
 
+    def pin_memory(self) -> DepthImageBatchDataInput:
+        self.depth_uncertainty_images = self.depth_uncertainty_images.pin_memory()
+        self.grasp_transforms = pin_memory_keep_ltype(self.grasp_transforms)
+        self.random_rotate_transform = (
+            pin_memory_keep_ltype(self.random_rotate_transform)
+            if self.random_rotate_transform is not None
+            else None
+        )
+        self.grasp_configs = self.grasp_configs.pin_memory()
+        return self
+
+    def record_stream(self, stream: torch.cuda.Stream) -> None:
+        self.depth_uncertainty_images.record_stream(stream)
+        # Record the raw tensors rather than relying on pypose's LieTensor dispatch
+        self.grasp_transforms.tensor().record_stream(stream)
+        if self.random_rotate_transform is not None:
+            self.random_rotate_transform.tensor().record_stream(stream)
+        self.grasp_configs.record_stream(stream)
+
     @property
     def augmented_grasp_transforms(self) -> pp.LieTensor:
         if self.random_rotate_transform is None:
@@ -281,18 +371,24 @@ class DepthImageBatchDataInput:
 
         # Apply random rotation to grasp config.
         # NOTE: hardcodes grasp_configs ordering
-        wrist_pose = pp.SE3(self.grasp_configs[..., :7])
+        wrist_pose = self.grasp_configs[..., :7]
         joint_angles = self.grasp_configs[..., 7:23]
-        grasp_orientations = pp.SO3(self.grasp_configs[..., 23:])
+        grasp_orientations = self.grasp_configs[..., 23:]
 
+        # Rotate wrist poses and grasp orientations with a single SE(3) product by
+        # treating the orientations as poses with zero translation.
         # Unsqueeze because we're applying the same (single) random rotation to all fingers.
-        wrist_pose = self.random_rotate_transform.unsqueeze(1) @ wrist_pose
-        grasp_orientations = (
-            self.random_rotate_transform.rotation().unsqueeze(1) @ grasp_orientations
+        n_fingers = self.grasp_configs.shape[1]
+        grasp_orientation_poses = torch.cat(
+            (torch.zeros_like(grasp_orientations[..., :3]), grasp_orientations), dim=-1
         )
+        stacked_poses = pp.SE3(torch.cat((wrist_pose, grasp_orientation_poses), dim=1))
+        stacked_poses = (self.random_rotate_transform.unsqueeze(1) @ stacked_poses).data
+        wrist_pose = stacked_poses[:, :n_fingers]
+        grasp_orientations = stacked_poses[:, n_fingers:, 3:]
 
         return_value = torch.cat(
-            (wrist_pose.data, joint_angles, grasp_orientations.data), axis=-1
+            (wrist_pose, joint_angles, grasp_orientations), axis=-1
         )
         assert (
             return_value.shape
@@ -329,12 +425,29 @@ class BatchDataOutput:
     passed_penetration_threshold: torch.Tensor
     passed_eval: torch.Tensor
 
-    def to(self, device) -> BatchDataOutput:
-        self.passed_simulation = self.passed_simulation.to(device)
-        self.passed_penetration_threshold = self.passed_penetration_threshold.to(device)
-        self.passed_eval = self.passed_eval.to(device)
+    def to(self, device, non_blocking: bool = False) -> BatchDataOutput:
+        self.passed_simulation = self.passed_simulation.to(
+            device, non_blocking=non_blocking
+        )
+        self.passed_penetration_threshold = self.passed_penetration_threshold.to(
+            device, non_blocking=non_blocking
+        )
+        self.passed_eval = self.passed_eval.to(device, non_blocking=non_blocking)
         return self
 
+    def pin_memory(self) -> BatchDataOutput:
+        self.passed_simulation = self.passed_simulation.pin_memory()
+        self.passed_penetration_threshold = (
+            self.passed_penetration_threshold.pin_memory()
+        )
+        self.passed_eval = self.passed_eval.pin_memory()
+        return self
+
+    def record_stream(self, stream: torch.cuda.Stream) -> None:
+        self.passed_simulation.record_stream(stream)
+        self.passed_penetration_threshold.record_stream(stream)
+        self.passed_eval.record_stream(stream)
+
     @property
     def batch_size(self) -> int:
         return self.passed_eval.shape[0]
@@ -350,11 +463,21 @@ class BatchData:
     output: BatchDataOutput
     nerf_config: List[str]
 
-    def to(self, device) -> BatchData:
-        self.input = self.input.to(device)
-        self.output = self.output.to(device)
+    def to(self, device, non_blocking: bool = False) -> BatchData:
+        self.input = self.input.to(device, non_blocking=non_blocking)
+        self.output = self.output.to(device, non_blocking=non_blocking)
         return self
 
+    def pin_memory(self) -> BatchData:
+        self.input = self.input.pin_memory()
+        self.output = self.output.pin_memory()
+        return self
+
+    def record_stream(self, stream: torch.cuda.Stream) -> None:
+        # Marks device tensors copied on a side stream as in use by `stream`
+        self.input.record_stream(stream)
+        self.output.record_stream(stream)
+
     @property
     def batch_size(self) -> int:
         return self.output.batch_size
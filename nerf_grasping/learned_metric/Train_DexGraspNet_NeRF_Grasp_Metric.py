@@ -37,6 +37,7 @@ from nerf_grasping.learned_metric.DexGraspNet_batch_data import (
 from nerf_grasping.dataset.DexGraspNet_NeRF_Grasps_utils import (
     get_object_code,
     get_object_scale,
+    load_scaled_mesh,
     plot_mesh_and_query_points,
     plot_mesh_and_transforms,
 )
@@ -55,18 +56,13 @@ from nerf_grasping.config.nerfdata_config import (
 from nerf_grasping.learned_metric.train_dataset import (
     NeRFGrid_To_GraspSuccess_HDF5_Dataset,
     DepthImage_To_GraspSuccess_HDF5_Dataset,
+    BatchedSubset,
+    HDF5_RDCC_NBYTES,
 )
 import os
 import pypose as pp
 import h5py
-from typing import Optional, Tuple, List, Dict, Any, Union
-from sklearn.metrics import (
-    accuracy_score,
-    f1_score,
-    precision_score,
-    recall_score,
-    balanced_accuracy_score,
-)
+from typing import Optional, Tuple, List, Dict, Any, Union, Callable, Iterator
 
 
 import numpy as np
@@ -77,7 +73,6 @@ from torch.utils.data import (
     Subset,
     random_split,
 )
-from sklearn.utils.class_weight import compute_class_weight
 import plotly.graph_objects as go
 from plotly.subplots import make_subplots
 import wandb
@@ -266,7 +261,6 @@ def set_seed(seed) -> None:
     torch.manual_seed(seed)
     torch.cuda.manual_seed(seed)
     np.random.seed(seed)
-    torch.set_num_threads(1)  # TODO: Is this slowing things down?
 
     # torch.backends.cudnn.deterministic = True
     # torch.backends.cudnn.benchmark = False
@@ -355,7 +349,6 @@ def create_depth_imgs_dataset(
         fingertip_camera_config=cfg.nerfdata_config.fingertip_camera_config,
         max_num_data_points=cfg.data.max_num_data_points,
         load_depth_images_in_ram=cfg.dataloader.load_nerf_grid_inputs_in_ram,
-        load_grasp_labels_in_ram=cfg.dataloader.load_grasp_labels_in_ram,
         load_grasp_transforms_in_ram=cfg.dataloader.load_grasp_transforms_in_ram,
         load_nerf_configs_in_ram=cfg.dataloader.load_nerf_configs_in_ram,
     )
@@ -371,7 +364,6 @@ def create_grid_dataset(
         fingertip_config=cfg.nerfdata_config.fingertip_config,
         max_num_data_points=cfg.data.max_num_data_points,
         load_nerf_densities_in_ram=cfg.dataloader.load_nerf_grid_inputs_in_ram,
-        load_grasp_labels_in_ram=cfg.dataloader.load_grasp_labels_in_ram,
         load_grasp_transforms_in_ram=cfg.dataloader.load_grasp_transforms_in_ram,
         load_nerf_configs_in_ram=cfg.dataloader.load_nerf_configs_in_ram,
     )
@@ -392,19 +384,62 @@ if cfg.create_val_test_from_train:
             input_hdf5_filepath=input_dataset_full_path, cfg=cfg
         )
 
-    train_dataset, val_dataset, test_dataset = random_split(
-        full_dataset,
-        [cfg.data.frac_train, cfg.data.frac_val, cfg.data.frac_test],
-        generator=torch.Generator().manual_seed(cfg.random_seed),
-    )
+    # Cache the split indices as int64 arrays in the checkpoint workspace so resumed runs reuse
+    # the exact split, and workers get compact arrays instead of long Python lists of ints
+    # Saved with everything that determines the split, so a stale file is caught on load
+    split_indices_filepath = cfg.checkpoint_workspace.output_dir / "split_indices.npz"
+    split_config = {
+        "dataset_len": np.int64(len(full_dataset)),
+        "fracs": np.array([cfg.data.frac_train, cfg.data.frac_val, cfg.data.frac_test]),
+        "random_seed": np.int64(cfg.random_seed),
+    }
+    if split_indices_filepath.exists():
+        print(f"Loading split indices from {split_indices_filepath}")
+        split_indices = np.load(split_indices_filepath)
+        for key, value in split_config.items():
+            saved_value = split_indices[key] if key in split_indices else None
+            assert saved_value is not None and np.array_equal(saved_value, value), (
+                f"{split_indices_filepath} does not match this dataset/split config"
+                f" ({key}: {saved_value} != {value}), delete it to regenerate the split"
+            )
+        train_dataset, val_dataset, test_dataset = [
+            BatchedSubset(full_dataset, split_indices[split_name])
+            for split_name in ["train", "val", "test"]
+        ]
+    else:
+        train_dataset, val_dataset, test_dataset = [
+            BatchedSubset(full_dataset, np.asarray(subset.indices, dtype=np.int64))
+            for subset in random_split(
+                full_dataset,
+                [cfg.data.frac_train, cfg.data.frac_val, cfg.data.frac_test],
+                generator=torch.Generator().manual_seed(cfg.random_seed),
+            )
+        ]
+        print(f"Saving split indices to {split_indices_filepath}")
+        np.savez(
+            split_indices_filepath,
+            train=train_dataset.indices,
+            val=val_dataset.indices,
+            test=test_dataset.indices,
+            **split_config,
+        )
     assert_equals(
-        len(set.intersection(set(train_dataset.indices), set(val_dataset.indices))), 0
+        np.intersect1d(
+            train_dataset.indices, val_dataset.indices, assume_unique=True
+        ).size,
+        0,
     )
     assert_equals(
-        len(set.intersection(set(train_dataset.indices), set(test_dataset.indices))), 0
+        np.intersect1d(
+            train_dataset.indices, test_dataset.indices, assume_unique=True
+        ).size,
+        0,
     )
     assert_equals(
-        len(set.intersection(set(val_dataset.indices), set(test_dataset.indices))), 0
+        np.intersect1d(
+            val_dataset.indices, test_dataset.indices, assume_unique=True
+        ).size,
+        0,
     )
 else:
     print(
@@ -439,7 +474,7 @@ print(f"Test dataset size: {len(test_dataset)}")
 # %%
 
 
-@localscope.mfc(allowed=["PP_MATRIX_ATOL", "PP_MATRIX_RTOL"])
+@localscope.mfc
 def sample_random_rotate_transforms(N: int) -> pp.LieTensor:
     # Sample big rotations in tangent space of SO(3).
     # Choose 4 * \pi as a heuristic to get pretty evenly spaced rotations.
@@ -450,36 +485,45 @@ def sample_random_rotate_transforms(N: int) -> pp.LieTensor:
     random_SO3_rotations = log_random_rotations.Exp()
 
     # A bit annoying -- need to cast SO(3) -> SE(3).
-    random_rotate_transforms = pp.from_matrix(
-        random_SO3_rotations.matrix(),
-        pp.SE3_type,
-        atol=PP_MATRIX_ATOL,
-        rtol=PP_MATRIX_RTOL,
+    # SE(3) data is [t, q], so prepend a zero translation instead of round-tripping
+    # through 4x4 matrices (and from_matrix's validity check) in the collate workers.
+    random_rotate_transforms = pp.SE3(
+        torch.cat(
+            [
+                torch.zeros(N, 3, dtype=random_SO3_rotations.dtype),
+                random_SO3_rotations.tensor(),
+            ],
+            dim=-1,
+        )
     )
 
     return random_rotate_transforms
 
 
-@localscope.mfc(allowed=["PP_MATRIX_ATOL", "PP_MATRIX_RTOL"])
+@localscope.mfc
 def sample_random_rotate_transforms_only_around_y(N: int) -> pp.LieTensor:
     # Sample big rotations in tangent space of SO(3).
     # Choose 4 * \pi as a heuristic to get pretty evenly spaced rotations.
     # TODO(pculbert): Figure out better uniform sampling on SO(3).
-    x_rotations = torch.zeros(N)
     y_rotations = 4 * torch.pi * (2 * torch.rand(N) - 1)
-    z_rotations = torch.zeros(N)
-    xyz_rotations = torch.stack([x_rotations, y_rotations, z_rotations], dim=-1)
-    log_random_rotations = pp.so3(xyz_rotations)
 
-    # Return exponentiated rotations.
-    random_SO3_rotations = log_random_rotations.Exp()
-
-    # A bit annoying -- need to cast SO(3) -> SE(3).
-    random_rotate_transforms = pp.from_matrix(
-        random_SO3_rotations.matrix(),
-        pp.SE3_type,
-        atol=PP_MATRIX_ATOL,
-        rtol=PP_MATRIX_RTOL,
+    # Exp of so(3) [0, theta, 0] is the quaternion [0, sin(theta / 2), 0, cos(theta / 2)],
+    # so build the SE(3) data [t, q] directly in one batched stack.
+    half_y_rotations = y_rotations / 2
+    zeros = torch.zeros(N)
+    random_rotate_transforms = pp.SE3(
+        torch.stack(
+            [
+                zeros,
+                zeros,
+                zeros,
+                zeros,
+                torch.sin(half_y_rotations),
+                zeros,
+                torch.cos(half_y_rotations),
+            ],
+            dim=-1,
+        )
     )
 
     return random_rotate_transforms
@@ -629,6 +673,30 @@ else:
         nerf_density_threshold_value=cfg.data.nerf_density_threshold_value,
     )  # Run test over actual test transforms.
 
+
+@localscope.mfc(allowed=["HDF5_RDCC_NBYTES"])
+def worker_init_fn(worker_id: int, num_workers: int, num_live_workers: int) -> None:
+    # Split the cores between workers instead of running each one single-threaded
+    # (the ops used are deterministic regardless of thread count)
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // num_workers))
+
+    # Open the HDF5 file up front so the first batch of each worker doesn't pay for it,
+    # with this worker's share of the total chunk cache budget across all live workers
+    dataset = torch.utils.data.get_worker_info().dataset
+    if isinstance(dataset, Subset):
+        dataset = dataset.dataset
+    if dataset.hdf5_file is None:
+        dataset.hdf5_file = dataset._open_hdf5_file(
+            rdcc_nbytes=max(64 * 1024**2, HDF5_RDCC_NBYTES // num_live_workers)
+        )
+
+
+USE_WORKERS = cfg.dataloader.num_workers > 0
+# Persistent train, val and test worker pools all stay alive (and keep their HDF5 chunk
+# caches) at once; otherwise only the loader being iterated has workers
+NUM_LIVE_WORKERS = cfg.dataloader.num_workers * (
+    3 if cfg.dataloader.persistent_workers else 1
+)
 train_loader = DataLoader(
     train_dataset,
     batch_size=cfg.dataloader.batch_size,
@@ -636,6 +704,13 @@ train_loader = DataLoader(
     pin_memory=cfg.dataloader.pin_memory,
     num_workers=cfg.dataloader.num_workers,
     collate_fn=train_collate_fn,
+    persistent_workers=USE_WORKERS and cfg.dataloader.persistent_workers,
+    prefetch_factor=cfg.dataloader.prefetch_factor if USE_WORKERS else None,
+    worker_init_fn=partial(
+        worker_init_fn,
+        num_workers=cfg.dataloader.num_workers,
+        num_live_workers=NUM_LIVE_WORKERS,
+    ),
 )
 val_loader = DataLoader(
     val_dataset,
@@ -644,6 +719,13 @@ val_loader = DataLoader(
     pin_memory=cfg.dataloader.pin_memory,
     num_workers=cfg.dataloader.num_workers,
     collate_fn=val_test_collate_fn,
+    persistent_workers=USE_WORKERS and cfg.dataloader.persistent_workers,
+    prefetch_factor=cfg.dataloader.prefetch_factor if USE_WORKERS else None,
+    worker_init_fn=partial(
+        worker_init_fn,
+        num_workers=cfg.dataloader.num_workers,
+        num_live_workers=NUM_LIVE_WORKERS,
+    ),
 )
 test_loader = DataLoader(
     test_dataset,
@@ -652,6 +734,13 @@ test_loader = DataLoader(
     pin_memory=cfg.dataloader.pin_memory,
     num_workers=cfg.dataloader.num_workers,
     collate_fn=val_test_collate_fn,
+    persistent_workers=USE_WORKERS and cfg.dataloader.persistent_workers,
+    prefetch_factor=cfg.dataloader.prefetch_factor if USE_WORKERS else None,
+    worker_init_fn=partial(
+        worker_init_fn,
+        num_workers=cfg.dataloader.num_workers,
+        num_live_workers=NUM_LIVE_WORKERS,
+    ),
 )
 
 if cfg.data.use_random_rotations:
@@ -688,7 +777,42 @@ def print_shapes(batch_data: BatchData) -> None:
     print(f"len(nerf_config): {len(batch_data.nerf_config)}")
 
 
-EXAMPLE_BATCH_DATA: BatchData = next(iter(train_loader))
+@localscope.mfc
+def get_example_batch_data(
+    dataset: Union[Subset, Any], collate_fn: Callable, batch_size: int, seed: int
+) -> BatchData:
+    # Read one random batch in the main process instead of iterating train_loader, which
+    # would start the (persistent) workers only to prefetch and then discard batches
+    # Generator.choice samples without replacement without permuting all of len(dataset)
+    idxs = np.random.default_rng(seed).choice(
+        len(dataset), size=min(batch_size, len(dataset)), replace=False
+    )
+    # Resolve the Subset here; torch.utils.data.Subset has no __getitems__ before 2.1
+    if isinstance(dataset, Subset):
+        full_dataset = dataset.dataset
+        full_idxs = [int(dataset.indices[i]) for i in idxs]
+    else:
+        full_dataset = dataset
+        full_idxs = idxs.tolist()
+    batch_data = collate_fn(
+        full_dataset.__getitems__(full_idxs)
+        if hasattr(full_dataset, "__getitems__")
+        else [full_dataset[i] for i in full_idxs]
+    )
+
+    # Close the main-process HDF5 handle so forked workers open their own
+    if full_dataset.hdf5_file is not None:
+        full_dataset.hdf5_file.close()
+        full_dataset.hdf5_file = None
+    return batch_data
+
+
+EXAMPLE_BATCH_DATA: BatchData = get_example_batch_data(
+    dataset=train_dataset,
+    collate_fn=train_collate_fn,
+    batch_size=cfg.dataloader.batch_size,
+    seed=cfg.random_seed,
+)
 print_shapes(batch_data=EXAMPLE_BATCH_DATA)
 
 # %% [markdown]
@@ -751,8 +875,7 @@ def nerf_densities_plot_example(
     mesh_path = DEXGRASPNET_MESHDATA_ROOT / object_code / "coacd" / "decomposed.obj"
 
     print(f"Loading mesh from {mesh_path}...")
-    mesh = trimesh.load(mesh_path, force="mesh")
-    mesh.apply_transform(trimesh.transformations.scale_matrix(object_scale))
+    mesh = load_scaled_mesh(mesh_path, object_scale)
     if additional_mesh_transform is not None:
         mesh.apply_transform(additional_mesh_transform)
 
@@ -778,19 +901,20 @@ def nerf_densities_plot_example(
             NUM_XYZ,
         ),
     )
-    query_points_list = [
-        query_points_list[finger_idx].reshape(-1, NUM_XYZ).cpu().numpy()
-        for finger_idx in range(NUM_FINGERS)
-    ]
-    query_point_colors_list = [
-        colors[finger_idx].reshape(-1).cpu().numpy()
-        for finger_idx in range(NUM_FINGERS)
-    ]
+    # Do the layout change on device and copy each tensor back once, rather than a
+    # strided reshape + transfer per finger
+    query_points_np = (
+        query_points_list.reshape(NUM_FINGERS, -1, NUM_XYZ).contiguous().cpu().numpy()
+    )
+    colors_np = colors.reshape(NUM_FINGERS, -1).cpu().numpy()
+    query_points_list = list(query_points_np)
+    query_point_colors_list = list(colors_np)
     fig = plot_mesh_and_query_points(
         mesh=mesh,
         query_points_list=query_points_list,
         query_points_colors_list=query_point_colors_list,
         num_fingers=NUM_FINGERS,
+        keep_top_fraction=0.1,
     )
     # Set title to label
     fig.update_layout(
@@ -846,13 +970,16 @@ def depth_image_plot_example(
         depth_uncertainty_images.shape,
         (NUM_FINGERS, DEPTH_IMAGE_N_CHANNELS, DEPTH_IMAGE_HEIGHT, DEPTH_IMAGE_WIDTH),
     )
-    depth_images, uncertainty_images = (
-        depth_uncertainty_images[:, 0],
-        depth_uncertainty_images[:, 1],
-    )
-    max_depth, max_uncertainty = (
-        depth_images.max().item(),
-        uncertainty_images.max().item(),
+
+    # Rescale each channel by its max and cast to uint8 on device, so only 1 byte per
+    # pixel is copied back (one reduction, one transfer)
+    max_depth_uncertainty = depth_uncertainty_images.amax(dim=(0, 2, 3), keepdim=True)
+    depth_uncertainty_images_uint8 = (
+        (depth_uncertainty_images * (255 / max_depth_uncertainty))
+        .clamp_(0, 255)
+        .to(torch.uint8)
+        .cpu()
+        .numpy()
     )
 
     passed_simulation = batch_data.output.passed_simulation[idx_to_visualize].tolist()
@@ -884,8 +1011,7 @@ def depth_image_plot_example(
     mesh_path = DEXGRASPNET_MESHDATA_ROOT / object_code / "coacd" / "decomposed.obj"
 
     print(f"Loading mesh from {mesh_path}...")
-    mesh = trimesh.load(mesh_path, force="mesh")
-    mesh.apply_transform(trimesh.transformations.scale_matrix(object_scale))
+    mesh = load_scaled_mesh(mesh_path, object_scale)
     if additional_mesh_transform is not None:
         mesh.apply_transform(additional_mesh_transform)
 
@@ -906,13 +1032,17 @@ def depth_image_plot_example(
     fig2 = make_subplots(rows=NUM_FINGERS, cols=2, subplot_titles=titles)
     for finger_idx in range(NUM_FINGERS):
         row = finger_idx + 1
-        depth_image = depth_images[finger_idx].cpu().numpy()
-        uncertainty_image = uncertainty_images[finger_idx].cpu().numpy()
+        depth_image = depth_uncertainty_images_uint8[finger_idx, 0]
+        uncertainty_image = depth_uncertainty_images_uint8[finger_idx, 1]
 
-        # Add 3 channels of this
+        # Add 3 channels of this as a stride-0 view rather than 3 copies
         N_CHANNELS = 3
-        depth_image = np.stack([depth_image] * N_CHANNELS, axis=-1)
-        uncertainty_image = np.stack([uncertainty_image] * N_CHANNELS, axis=-1)
+        depth_image = np.broadcast_to(
+            depth_image[..., None], (*depth_image.shape, N_CHANNELS)
+        )
+        uncertainty_image = np.broadcast_to(
+            uncertainty_image[..., None], (*uncertainty_image.shape, N_CHANNELS)
+        )
         assert_equals(
             depth_image.shape, (DEPTH_IMAGE_HEIGHT, DEPTH_IMAGE_WIDTH, N_CHANNELS)
         )
@@ -920,10 +1050,6 @@ def depth_image_plot_example(
             uncertainty_image.shape, (DEPTH_IMAGE_HEIGHT, DEPTH_IMAGE_WIDTH, N_CHANNELS)
         )
 
-        # Rescale
-        depth_image = (depth_image * 255 / max_depth).astype(int)
-        uncertainty_image = (uncertainty_image * 255 / max_uncertainty).astype(int)
-
         fig2.add_trace(go.Image(z=depth_image), row=row, col=1)
         fig2.add_trace(go.Image(z=uncertainty_image), row=row, col=2)
 
@@ -1006,6 +1132,11 @@ else:
         n_tasks=cfg.task_type.n_tasks,
     ).to(device)
 
+if cfg.training.compile_model:
+    # Compile the tensor-in / tensor-out inner model rather than the classifier (which
+    # takes BatchDataInput), and patch forward so state_dict keys are unchanged
+    classifier.model.forward = torch.compile(classifier.model.forward)
+
 # %%
 start_epoch = 0
 optimizer = torch.optim.AdamW(
@@ -1013,6 +1144,7 @@ optimizer = torch.optim.AdamW(
     lr=cfg.training.lr,
     betas=cfg.training.betas,
     weight_decay=cfg.training.weight_decay,
+    fused=device.type == "cuda",  # Single fused kernel per step; needs CUDA params
 )
 lr_scheduler = get_scheduler(
     name=cfg.training.lr_scheduler_name,
@@ -1036,7 +1168,8 @@ if cfg.checkpoint_workspace.input_dir is not None:
         latest_checkpoint_path is not None and latest_checkpoint_path.exists()
     ), f"latest_checkpoint_path does not exist at {latest_checkpoint_path}"
 
-    checkpoint = torch.load(latest_checkpoint_path)
+    # Load onto CPU; load_state_dict copies into the (already on-device) params / optimizer state
+    checkpoint = torch.load(latest_checkpoint_path, map_location="cpu")
     classifier.load_state_dict(checkpoint["classifier"])
     optimizer.load_state_dict(checkpoint["optimizer"])
     start_epoch = checkpoint["epoch"]
@@ -1053,54 +1186,59 @@ print(f"optimizer = {optimizer}")
 print(f"lr_scheduler = {lr_scheduler}")
 
 # %%
-try:
-    summary(
-        model=classifier,
-        input_size=(
-            cfg.dataloader.batch_size,
-            NUM_FINGERS,
-            NUM_PTS_X,
-            NUM_PTS_Y,
-            NUM_PTS_Z,
-        ),
-        device=device,
-    )
-except Exception as e:
-    print(f"Exception: {e}")
-    print("Skipping summary")
-
-# %%
-try:
-    example_input = (
-        torch.zeros(
-            (
+# Both need an extra forward pass at startup, so only run them when asked
+if cfg.visualize_model:
+    try:
+        summary(
+            model=classifier,
+            input_size=(
                 cfg.dataloader.batch_size,
                 NUM_FINGERS,
                 NUM_PTS_X,
                 NUM_PTS_Y,
                 NUM_PTS_Z,
+            ),
+            device=device,
+        )
+    except Exception as e:
+        print(f"Exception: {e}")
+        print("Skipping summary")
+
+# %%
+if cfg.visualize_model:
+    try:
+        example_input = (
+            torch.zeros(
+                (
+                    cfg.dataloader.batch_size,
+                    NUM_FINGERS,
+                    NUM_PTS_X,
+                    NUM_PTS_Y,
+                    NUM_PTS_Z,
+                )
             )
+            .to(device)
+            .requires_grad_(True)
         )
-        .to(device)
-        .requires_grad_(True)
-    )
-    example_output = classifier(example_input)
-    dot = make_dot(
-        example_output,
-        params={
-            **dict(classifier.named_parameters()),
-            **{"NERF_INPUT": example_input},
-            **{"GRASP_LABELS": example_output},
-        },
-    )
-    model_graph_filename = "model_graph.png"
-    model_graph_filename_no_ext, model_graph_file_ext = model_graph_filename.split(".")
-    print(f"Saving to {model_graph_filename}...")
-    dot.render(model_graph_filename_no_ext, format=model_graph_file_ext)
-    print(f"Done saving to {model_graph_filename}")
-except Exception as e:
-    print(f"Exception: {e}")
-    print("Skipping make_dot")
+        example_output = classifier(example_input)
+        dot = make_dot(
+            example_output,
+            params={
+                **dict(classifier.named_parameters()),
+                **{"NERF_INPUT": example_input},
+                **{"GRASP_LABELS": example_output},
+            },
+        )
+        model_graph_filename = "model_graph.png"
+        model_graph_filename_no_ext, model_graph_file_ext = model_graph_filename.split(
+            "."
+        )
+        print(f"Saving to {model_graph_filename}...")
+        dot.render(model_graph_filename_no_ext, format=model_graph_file_ext)
+        print(f"Done saving to {model_graph_filename}")
+    except Exception as e:
+        print(f"Exception: {e}")
+        print("Skipping make_dot")
 
 SHOW_DOT = False
 if SHOW_DOT:
@@ -1136,6 +1274,52 @@ def save_checkpoint(
 
 
 # %%
+@localscope.mfc
+def _summarize_losses(losses: np.ndarray) -> Dict[str, float]:
+    # Get min/quartiles/max from a single sort
+    (
+        loss_min,
+        loss_quartile_25,
+        loss_median,
+        loss_quartile_75,
+        loss_max,
+    ) = np.quantile(losses, [0.0, 0.25, 0.5, 0.75, 1.0])
+    return {
+        "": losses.mean(),
+        "_min": loss_min,
+        "_quartile_25": loss_quartile_25,
+        "_median": loss_median,
+        "_quartile_75": loss_quartile_75,
+        "_max": loss_max,
+    }
+
+
+@localscope.mfc
+def _prefetch_to_device(
+    dataloader: DataLoader, device: torch.device
+) -> Iterator[BatchData]:
+    # Copy the next batch on a side stream so its H2D transfer overlaps the current
+    # batch's compute. Batches are pinned by the DataLoader (BatchData.pin_memory).
+    if device.type != "cuda":
+        for batch_data in dataloader:
+            yield batch_data.to(device, non_blocking=True)
+        return
+
+    copy_stream = torch.cuda.Stream(device=device)
+    current_stream = torch.cuda.current_stream(device=device)
+    ready_batch_data = None
+    for batch_data in dataloader:
+        with torch.cuda.stream(copy_stream):
+            batch_data = batch_data.to(device, non_blocking=True)
+        if ready_batch_data is not None:
+            yield ready_batch_data
+        current_stream.wait_stream(copy_stream)
+        batch_data.record_stream(current_stream)
+        ready_batch_data = batch_data
+    if ready_batch_data is not None:
+        yield ready_batch_data
+
+
 @localscope.mfc(allowed=["tqdm", "USE_DEPTH_IMAGES"])
 def _iterate_through_dataloader(
     loop_timer: LoopTimer,
@@ -1150,27 +1334,66 @@ def _iterate_through_dataloader(
     lr_scheduler: Optional[torch.optim.lr_scheduler.LRScheduler] = None,
     max_num_batches: Optional[int] = None,
     log_every_n_batches: int = 5,
-) -> Tuple[Dict[str, List[float]], Dict[str, List[float]], Dict[str, List[float]]]:
-    losses_dict = defaultdict(list)  # loss name => list of losses (one per datapoint)
+    use_bf16_autocast: bool = False,
+) -> Tuple[Dict[str, np.ndarray], Dict[str, np.ndarray], Dict[str, np.ndarray]]:
+    losses_dict = defaultdict(list)  # loss name => list of loss chunks (one per flush)
     predictions_dict, ground_truths_dict = defaultdict(list), defaultdict(
         list
-    )  # task name => list of predictions / ground truths (one per datapoint)
+    )  # task name => list of prediction / ground truth chunks (one per flush)
+    running_loss_stats = defaultdict(
+        lambda: {"n": 0, "sum": 0.0, "min": float("inf"), "max": float("-inf")}
+    )  # loss name => running count / sum / min / max (for the progress bar)
 
     assert phase in [Phase.TRAIN, Phase.VAL, Phase.TEST, Phase.EVAL_TRAIN]
+    # train()/eval() walk every submodule, so only toggle when the mode changes
     if phase == Phase.TRAIN:
-        classifier.train()
+        if not classifier.training:
+            classifier.train()
         assert training_cfg is not None and optimizer is not None
     else:
-        classifier.eval()
+        if classifier.training:
+            classifier.eval()
         assert training_cfg is None and optimizer is None
 
     assert_equals(len(loss_fns), classifier.n_tasks)
     assert_equals(len(task_type.task_names), classifier.n_tasks)
 
+    # Per-datapoint values stay on device as (num_keys, batch_size) tensors and are
+    # copied to the CPU in one transfer every log_every_n_batches, instead of a
+    # .tolist() sync per value per batch.
+    # Order must match the order values are appended in the loop below.
+    pending_keys = (
+        [(losses_dict, f"{task_name}_loss") for task_name in task_type.task_names]
+        + [(losses_dict, "loss")]
+        + [
+            (values_dict, task_name)
+            for task_name in task_type.task_names
+            for values_dict in [predictions_dict, ground_truths_dict]
+        ]
+    )
+    pending_values = []
+
+    def flush_pending_values() -> None:
+        if len(pending_values) == 0:
+            return
+        all_new_values = torch.cat(pending_values, dim=-1).cpu().numpy()
+        pending_values.clear()
+        for (values_dict, key), new_values in zip(pending_keys, all_new_values):
+            values_dict[key].append(new_values)
+            if values_dict is losses_dict:
+                stats = running_loss_stats[key]
+                stats["n"] += len(new_values)
+                stats["sum"] += new_values.sum()
+                stats["min"] = min(stats["min"], new_values.min())
+                stats["max"] = max(stats["max"], new_values.max())
+
     with torch.set_grad_enabled(phase == Phase.TRAIN):
         dataload_section_timer = loop_timer.add_section_timer("Data").start()
         for batch_idx, batch_data in (
-            pbar := tqdm(enumerate(dataloader), total=len(dataloader))
+            pbar := tqdm(
+                enumerate(_prefetch_to_device(dataloader, device)),
+                total=len(dataloader),
+            )
         ):
             dataload_section_timer.stop()
 
@@ -1179,7 +1402,7 @@ def _iterate_through_dataloader(
             if max_num_batches is not None and batch_idx >= max_num_batches:
                 break
 
-            batch_data: BatchData = batch_data.to(device)
+            batch_data: BatchData
             if (
                 USE_DEPTH_IMAGES
                 and torch.isnan(batch_data.input.depth_uncertainty_images).any()
@@ -1209,8 +1432,13 @@ def _iterate_through_dataloader(
                 continue
 
             # Forward pass
-            with loop_timer.add_section_timer("Fwd"):
-                all_logits = classifier.get_all_logits(batch_data.input)
+            with loop_timer.add_section_timer("Fwd"), torch.autocast(
+                device_type=device.type,
+                dtype=torch.bfloat16,
+                enabled=use_bf16_autocast,
+            ):
+                # fp32 logits for the losses / predictions (no-op without autocast)
+                all_logits = classifier.get_all_logits(batch_data.input).float()
                 assert_equals(
                     all_logits.shape,
                     (
@@ -1236,6 +1464,7 @@ def _iterate_through_dataloader(
 
                 assert_equals(len(task_targets), classifier.n_tasks)
 
+                batch_values = []
                 task_losses = []
                 for task_i, (loss_fn, task_target, task_name) in enumerate(
                     zip(loss_fns, task_targets, task_type.task_names)
@@ -1246,7 +1475,7 @@ def _iterate_through_dataloader(
                         target=task_target,
                     )
                     assert task_loss.shape == (batch_data.batch_size,)
-                    losses_dict[f"{task_name}_loss"].extend(task_loss.tolist())
+                    batch_values.append(task_loss.detach())
                     task_losses.append(task_loss)
                 task_losses = torch.stack(task_losses, dim=0)
                 assert_equals(
@@ -1268,10 +1497,14 @@ def _iterate_through_dataloader(
                         training_cfg is not None
                         and training_cfg.grad_clip_val is not None
                     ):
-                        torch.nn.utils.clip_grad_value_(
-                            classifier.parameters(),
-                            training_cfg.grad_clip_val,
-                        )
+                        # Multi-tensor clamps instead of one clamp_ launch per parameter
+                        grads = [
+                            p.grad
+                            for p in classifier.parameters()
+                            if p.grad is not None
+                        ]
+                        torch._foreach_clamp_min_(grads, -training_cfg.grad_clip_val)
+                        torch._foreach_clamp_max_(grads, training_cfg.grad_clip_val)
 
                     optimizer.step()
                     if lr_scheduler is not None:
@@ -1279,7 +1512,7 @@ def _iterate_through_dataloader(
 
             # Loss logging
             with loop_timer.add_section_timer("Loss"):
-                losses_dict["loss"].extend(total_losses.tolist())
+                batch_values.append(total_losses.detach())
 
             # Gather predictions
             with loop_timer.add_section_timer("Gather"):
@@ -1295,8 +1528,12 @@ def _iterate_through_dataloader(
                     assert_equals(predictions.shape, (batch_data.batch_size,))
                     assert_equals(ground_truths.shape, (batch_data.batch_size,))
 
-                    predictions_dict[f"{task_name}"] += predictions.tolist()
-                    ground_truths_dict[f"{task_name}"] += ground_truths.tolist()
+                    batch_values.append(predictions.detach())
+                    batch_values.append(ground_truths)
+
+                pending_values.append(torch.stack(batch_values, dim=0))
+                if log_every_n_batches is None or batch_idx % log_every_n_batches == 0:
+                    flush_pending_values()
 
             if (
                 wandb.run is not None
@@ -1306,27 +1543,12 @@ def _iterate_through_dataloader(
             ):
                 with loop_timer.add_section_timer("Log"):
                     mid_epoch_log_dict = {}
-                    for loss_name, losses in losses_dict.items():
+                    for loss_name, loss_chunks in losses_dict.items():
+                        loss_stats = _summarize_losses(np.concatenate(loss_chunks))
                         mid_epoch_log_dict.update(
                             {
-                                f"mid_epoch/{phase.name.lower()}_{loss_name}": np.mean(
-                                    losses
-                                ),
-                                f"mid_epoch/{phase.name.lower()}_{loss_name}_min": np.min(
-                                    losses
-                                ),
-                                f"mid_epoch/{phase.name.lower()}_{loss_name}_quartile_25": np.quantile(
-                                    losses, 0.25
-                                ),
-                                f"mid_epoch/{phase.name.lower()}_{loss_name}_median": np.median(
-                                    losses
-                                ),
-                                f"mid_epoch/{phase.name.lower()}_{loss_name}_quartile_75": np.quantile(
-                                    losses, 0.75
-                                ),
-                                f"mid_epoch/{phase.name.lower()}_{loss_name}_max": np.max(
-                                    losses
-                                ),
+                                f"mid_epoch/{phase.name.lower()}_{loss_name}{suffix}": value
+                                for suffix, value in loss_stats.items()
                             }
                         )
                     wandb.log(mid_epoch_log_dict)
@@ -1334,16 +1556,15 @@ def _iterate_through_dataloader(
                 loop_timer.pretty_print_section_times()
 
             # Set description
-            if len(losses_dict["loss"]) > 0:
+            # Quartiles are still logged mid-epoch, but recomputing them over every loss
+            # so far on each batch is quadratic in the epoch length
+            if len(running_loss_stats) > 0:
                 loss_log_strs = [
                     f"{loss_name}: "
-                    + f"{np.mean(losses):.3f} "
-                    + f"({np.min(losses):.3f}, "
-                    + f"{np.quantile(losses, 0.25):.3f}, "
-                    + f"{np.median(losses):.3f}, "
-                    + f"{np.quantile(losses, 0.75):.3f}, "
-                    + f"{np.max(losses):.3f})"
-                    for loss_name, losses in losses_dict.items()
+                    + f"{stats['sum'] / stats['n']:.3f} "
+                    + f"({stats['min']:.3f}, "
+                    + f"{stats['max']:.3f})"
+                    for loss_name, stats in running_loss_stats.items()
                 ]
 
             else:
@@ -1361,20 +1582,37 @@ def _iterate_through_dataloader(
                 # Avoid starting timer at end of last batch
                 dataload_section_timer = loop_timer.add_section_timer("Data").start()
 
+    flush_pending_values()
+
+    # Join the per-flush chunks once, instead of growing Python lists per datapoint
+    losses_dict, predictions_dict, ground_truths_dict = [
+        {key: np.concatenate(chunks) for key, chunks in values_dict.items()}
+        for values_dict in [losses_dict, predictions_dict, ground_truths_dict]
+    ]
     return losses_dict, predictions_dict, ground_truths_dict
 
 
 @localscope.mfc
 def _create_wandb_scatter_plot(
-    ground_truths: List[float],
-    predictions: List[float],
+    ground_truths: np.ndarray,
+    predictions: np.ndarray,
     title: str,
+    max_num_points: int = 10_000,
 ) -> wandb.plots.Plot:
     # data = [[x, y] for (x, y) in zip(class_x_scores, class_y_scores)]
     # table = wandb.Table(data=data, columns=["class_x", "class_y"])
     # wandb.log({"my_custom_id": wandb.plot.scatter(table, "class_x", "class_y")})
-    data = [[x, y] for (x, y) in zip(ground_truths, predictions)]
-    table = wandb.Table(data=data, columns=["ground_truth", "prediction"])
+    data = np.stack([ground_truths, predictions], axis=-1)
+
+    # wandb only renders the first 10k rows of a custom chart table anyway, so send a
+    # fixed random subsample instead of every datapoint of the epoch
+    if len(data) > max_num_points:
+        data = data[
+            np.random.default_rng(0).choice(
+                len(data), size=max_num_points, replace=False
+            )
+        ]
+    table = wandb.Table(data=data.tolist(), columns=["ground_truth", "prediction"])
     return wandb.plot.scatter(
         table=table,
         x="ground_truth",
@@ -1383,14 +1621,41 @@ def _create_wandb_scatter_plot(
     )
 
 
+@localscope.mfc
+def _compute_binary_classification_metrics(
+    y_true: np.ndarray, y_pred: np.ndarray
+) -> Dict[str, float]:
+    # Same values as sklearn's accuracy/precision/recall/f1 (0.0 on zero division), from
+    # one set of counts instead of four validated passes over Python lists
+    n_true_positives = np.count_nonzero((y_true == 1) & (y_pred == 1))
+    n_predicted_positives = np.count_nonzero(y_pred == 1)
+    n_actual_positives = np.count_nonzero(y_true == 1)
+    return {
+        "accuracy": np.count_nonzero(y_true == y_pred) / len(y_true),
+        "precision": (
+            n_true_positives / n_predicted_positives
+            if n_predicted_positives > 0
+            else 0.0
+        ),
+        "recall": (
+            n_true_positives / n_actual_positives if n_actual_positives > 0 else 0.0
+        ),
+        "f1": (
+            2 * n_true_positives / (n_predicted_positives + n_actual_positives)
+            if n_predicted_positives + n_actual_positives > 0
+            else 0.0
+        ),
+    }
+
+
 @localscope.mfc
 def create_log_dict(
     phase: Phase,
     loop_timer: LoopTimer,
     task_type: TaskType,
-    losses_dict: Dict[str, List[float]],
-    predictions_dict: Dict[str, List[float]],
-    ground_truths_dict: Dict[str, List[float]],
+    losses_dict: Dict[str, np.ndarray],
+    predictions_dict: Dict[str, np.ndarray],
+    ground_truths_dict: Dict[str, np.ndarray],
     optimizer: Optional[torch.optim.Optimizer] = None,
 ) -> Dict[str, Any]:
     temp_log_dict = {}  # Make code cleaner by excluding phase name until the end
@@ -1399,12 +1664,12 @@ def create_log_dict(
 
     with loop_timer.add_section_timer("Agg Loss"):
         for loss_name, losses in losses_dict.items():
-            temp_log_dict[f"{loss_name}"] = np.mean(losses)
-            temp_log_dict[f"{loss_name}_min"] = np.min(losses)
-            temp_log_dict[f"{loss_name}_quartile_25"] = np.quantile(losses, 0.25)
-            temp_log_dict[f"{loss_name}_median"] = np.median(losses)
-            temp_log_dict[f"{loss_name}_quartile_75"] = np.quantile(losses, 0.75)
-            temp_log_dict[f"{loss_name}_max"] = np.max(losses)
+            temp_log_dict.update(
+                {
+                    f"{loss_name}{suffix}": value
+                    for suffix, value in _summarize_losses(losses).items()
+                }
+            )
 
     with loop_timer.add_section_timer("Scatter"):
         # Make scatter plot of predicted vs ground truth
@@ -1419,36 +1684,33 @@ def create_log_dict(
                 title=f"{phase.name.title()} {task_name} Scatter Plot",
             )
 
+    # Round to class labels once; shared by the metrics and the confusion matrix
+    rounded_predictions_dict = {
+        task_name: predictions_dict[task_name].round().astype(int)
+        for task_name in task_type.task_names
+    }
+    rounded_ground_truths_dict = {
+        task_name: ground_truths_dict[task_name].round().astype(int)
+        for task_name in task_type.task_names
+    }
+
     with loop_timer.add_section_timer("Metrics"):
         assert_equals(set(predictions_dict.keys()), set(ground_truths_dict.keys()))
         assert_equals(set(predictions_dict.keys()), set(task_type.task_names))
         for task_name in task_type.task_names:
-            predictions = (
-                np.array(predictions_dict[task_name]).round().astype(int).tolist()
+            metrics = _compute_binary_classification_metrics(
+                y_true=rounded_ground_truths_dict[task_name],
+                y_pred=rounded_predictions_dict[task_name],
             )
-            ground_truths = (
-                np.array(ground_truths_dict[task_name]).round().astype(int).tolist()
-            )
-            for metric_name, function in [
-                ("accuracy", accuracy_score),
-                ("precision", precision_score),
-                ("recall", recall_score),
-                ("f1", f1_score),
-            ]:
-                temp_log_dict[f"{task_name}_{metric_name}"] = function(
-                    y_true=ground_truths, y_pred=predictions
-                )
+            for metric_name, value in metrics.items():
+                temp_log_dict[f"{task_name}_{metric_name}"] = value
 
     with loop_timer.add_section_timer("Confusion Matrix"):
         assert_equals(set(predictions_dict.keys()), set(ground_truths_dict.keys()))
         assert_equals(set(predictions_dict.keys()), set(task_type.task_names))
         for task_name in task_type.task_names:
-            predictions = (
-                np.array(predictions_dict[task_name]).round().astype(int).tolist()
-            )
-            ground_truths = (
-                np.array(ground_truths_dict[task_name]).round().astype(int).tolist()
-            )
+            predictions = rounded_predictions_dict[task_name].tolist()
+            ground_truths = rounded_ground_truths_dict[task_name].tolist()
             temp_log_dict[
                 f"{task_name}_confusion_matrix"
             ] = wandb.plot.confusion_matrix(
@@ -1475,6 +1737,7 @@ def iterate_through_dataloader(
     training_cfg: Optional[ClassifierTrainingConfig] = None,
     optimizer: Optional[torch.optim.Optimizer] = None,
     lr_scheduler: Optional[torch.optim.lr_scheduler.LRScheduler] = None,
+    use_bf16_autocast: bool = False,
 ) -> Dict[str, Any]:
     assert_equals(len(loss_fns), classifier.n_tasks)
     assert_equals(len(task_type.task_names), classifier.n_tasks)
@@ -1493,6 +1756,7 @@ def iterate_through_dataloader(
         training_cfg=training_cfg,
         optimizer=optimizer,
         lr_scheduler=lr_scheduler,
+        use_bf16_autocast=use_bf16_autocast,
     )
 
     # Log
@@ -1564,6 +1828,7 @@ def run_training_loop(
             training_cfg=training_cfg,
             optimizer=optimizer,
             lr_scheduler=lr_scheduler,
+            use_bf16_autocast=training_cfg.use_bf16_autocast,
         )
         wandb_log_dict.update(train_log_dict)
         train_time_taken = time.time() - start_train_time
@@ -1574,7 +1839,6 @@ def run_training_loop(
         if epoch % training_cfg.val_freq == 0 and (
             epoch != 0 or training_cfg.val_on_epoch_0
         ):
-            classifier.eval()
             val_log_dict = iterate_through_dataloader(
                 phase=Phase.VAL,
                 dataloader=val_loader,
@@ -1582,12 +1846,11 @@ def run_training_loop(
                 device=device,
                 loss_fns=loss_fns,
                 task_type=task_type,
+                use_bf16_autocast=training_cfg.use_bf16_autocast,
             )
             wandb_log_dict.update(val_log_dict)
         val_time_taken = time.time() - start_val_time
 
-        classifier.train()
-
         if wandb.run is not None:
             wandb.log(wandb_log_dict)
 
@@ -1615,8 +1878,7 @@ wandb.watch(classifier, log="gradients", log_freq=100)
 def get_unique_classes(success_rates: np.ndarray) -> np.ndarray:
     # [0.5, 0.2, 0.1, 0.5, 0.0, 0.0, ...] => [0, 0.1, 0.2, ...]
     assert success_rates.ndim == 1
-    unique_classes = np.unique(success_rates)
-    return np.sort(unique_classes)
+    return np.unique(success_rates)  # Already sorted
 
 
 @localscope.mfc
@@ -1625,38 +1887,51 @@ def get_class_from_success_rate(
 ) -> int:
     # [0.5, 0.2, 0.1, 0.5, 0.0, 0.0, ...], [0, 0.1, 0.2, ...] => [5, 2, 1, 5, 0, 0, ...]
     assert unique_classes.ndim == 1
-    errors = np.absolute(unique_classes[None, :] - success_rates[:, None])
-    return errors.argmin(axis=-1)
+    if len(unique_classes) == 1:
+        return np.zeros(len(success_rates), dtype=int)
+
+    # Nearest class via binary search on the sorted classes, rather than an (N, C) error matrix
+    right_idxs = np.clip(
+        np.searchsorted(unique_classes, success_rates), 1, len(unique_classes) - 1
+    )
+    left_idxs = right_idxs - 1
+    closer_to_left = (success_rates - unique_classes[left_idxs]) <= (
+        unique_classes[right_idxs] - success_rates
+    )
+    return np.where(closer_to_left, left_idxs, right_idxs)
 
 
 @localscope.mfc
 def _compute_class_weight(
     success_rates: np.ndarray, unique_classes: np.ndarray
 ) -> np.ndarray:
-    classes = np.arange(len(unique_classes))
+    n_classes = len(unique_classes)
     y_classes = get_class_from_success_rate(
         success_rates=success_rates, unique_classes=unique_classes
     )
-    return compute_class_weight(
-        class_weight="balanced",
-        classes=classes,
-        y=y_classes,
-    )
+    # Same as sklearn's compute_class_weight("balanced"), from a single bincount
+    class_counts = np.bincount(y_classes, minlength=n_classes)
+    assert np.all(class_counts > 0), f"Empty class in {class_counts}"
+    return len(y_classes) / (n_classes * class_counts)
 
 
 @localscope.mfc
 def compute_class_weight_np(
-    train_dataset: Union[Subset, Any], input_dataset_full_path: str
+    train_dataset: Union[Subset, Any]
 ) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
     # TODO: May break if train_dataset is not a subset, but separate val/test files
     print("Loading grasp success data for class weighting...")
     t1 = time.time()
-    with h5py.File(input_dataset_full_path, "r") as hdf5_file:
-        passed_simulations_np = np.array(hdf5_file["/passed_simulation"][()])
-        passed_penetration_threshold_np = np.array(
-            hdf5_file["/passed_penetration_threshold"][()]
-        )
-        passed_eval_np = np.array(hdf5_file["/passed_eval"][()])
+    # The dataset already holds the labels in RAM as (N, 2) classes, so reuse them
+    # instead of opening the HDF5 file again
+    full_dataset = (
+        train_dataset.dataset if isinstance(train_dataset, Subset) else train_dataset
+    )
+    passed_simulations_np = full_dataset.passed_simulations[:, 1].numpy()
+    passed_penetration_threshold_np = (
+        full_dataset.passed_penetration_thresholds[:, 1].numpy()
+    )
+    passed_eval_np = full_dataset.passed_evals[:, 1].numpy()
     t2 = time.time()
     print(f"Loaded grasp success data in {t2 - t1:.2f} s")
 
@@ -1711,9 +1986,7 @@ def compute_class_weight_np(
     unique_passed_simulations,
     unique_passed_penetration_threshold,
     unique_passed_eval,
-) = compute_class_weight_np(
-    train_dataset=train_dataset, input_dataset_full_path=input_dataset_full_path
-)
+) = compute_class_weight_np(train_dataset=train_dataset)
 passed_simulation_class_weight = (
     torch.from_numpy(passed_simulation_class_weight).float().to(device)
 )
@@ -1789,8 +2062,9 @@ class WeightedSoftmaxL1(nn.Module):
         **kwargs,
     ) -> None:
         super().__init__()
-        self.unique_label_weights = unique_label_weights
-        self.unique_labels = unique_labels
+        # Buffers (like nn.CrossEntropyLoss's weight) so they follow .to() / compile
+        self.register_buffer("unique_label_weights", unique_label_weights)
+        self.register_buffer("unique_labels", unique_labels)
 
         (N,) = self.unique_labels.shape
         (N2,) = self.unique_label_weights.shape
@@ -1833,8 +2107,9 @@ class WeightedSoftmaxL2(nn.Module):
         **kwargs,
     ) -> None:
         super().__init__()
-        self.unique_label_weights = unique_label_weights
-        self.unique_labels = unique_labels
+        # Buffers (like nn.CrossEntropyLoss's weight) so they follow .to() / compile
+        self.register_buffer("unique_label_weights", unique_label_weights)
+        self.register_buffer("unique_labels", unique_labels)
 
         (N,) = self.unique_labels.shape
         (N2,) = self.unique_label_weights.shape
@@ -2238,6 +2513,7 @@ test_log_dict = iterate_through_dataloader(
     device=device,
     loss_fns=loss_fns,
     task_type=cfg.task_type,
+    use_bf16_autocast=cfg.training.use_bf16_autocast,
 )
 wandb_log_dict.update(test_log_dict)
 wandb.log(wandb_log_dict)
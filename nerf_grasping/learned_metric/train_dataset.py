@@ -1,7 +1,11 @@
-from typing import Optional
+from typing import Callable, List, Optional
+import json
+import os
+import pathlib
+import tempfile
 import numpy as np
 import torch
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, Subset
 import h5py
 import pypose as pp
 from nerf_grasping.config.fingertip_config import BaseFingertipConfig
@@ -13,10 +17,107 @@ from nerf_grasping.config.camera_config import CameraConfig
 PP_MATRIX_ATOL, PP_MATRIX_RTOL = 1e-4, 1e-4
 
 
+# Total HDF5 chunk cache budget (split across dataloader workers)
+HDF5_RDCC_NBYTES = 1024**2 * 4_000
+
+
 def assert_equals(a, b):
     assert a == b, f"{a} != {b}"
 
 
+def get_rdcc_nslots(rdcc_nbytes: int, min_chunk_nbytes: int = 64 * 1024) -> int:
+    # HDF5 recommends a prime number of hash slots, well above the number of chunks that fit in the cache
+    # Datapoint chunks are >= 64 KB (one datapoint per chunk), so this leaves >= 10x headroom for the grids
+    nslots = max(rdcc_nbytes // min_chunk_nbytes, 1) | 1
+    while any(nslots % i == 0 for i in range(3, int(nslots**0.5) + 1, 2)):
+        nslots += 2
+    return nslots
+
+
+def _write_file_atomically(
+    filepath: pathlib.Path, write_fn: Callable[[pathlib.Path], None]
+) -> None:
+    # Write to a uniquely named temp file in the same directory, then rename, so readers and
+    # concurrent writers never see a partial file
+    with tempfile.NamedTemporaryFile(
+        dir=filepath.parent, prefix=filepath.name + ".", suffix=".tmp", delete=False
+    ) as tmp_file:
+        tmp_filepath = pathlib.Path(tmp_file.name)
+    try:
+        write_fn(tmp_filepath)
+        os.replace(tmp_filepath, filepath)
+    except BaseException:
+        tmp_filepath.unlink(missing_ok=True)
+        raise
+
+
+def load_hdf5_datasets_as_memmap(
+    hdf5_file: h5py.File,
+    input_hdf5_filepath: str,
+    keys: List[str],
+    chunk_size: int = 1_000,
+) -> torch.Tensor:
+    # Instead of reading the whole dataset into (per-worker) private memory, convert it once to an
+    # .npy file next to the HDF5 file and memory-map it, so all workers share the page cache
+    # Multiple keys are stacked at dim=-3, the same way the datasets stack depth and uncertainty images
+    cache_filepath = pathlib.Path(input_hdf5_filepath).with_suffix(
+        "." + "_".join(key.strip("/") for key in keys) + ".npy"
+    )
+    # Sidecar describing the HDF5 file the cache was built from, so a regenerated dataset at the
+    # same path rebuilds the cache instead of silently reading stale data
+    metadata_filepath = cache_filepath.with_suffix(".json")
+    shape = hdf5_file[keys[0]].shape
+    if len(keys) > 1:
+        shape = (*shape[:-2], len(keys), *shape[-2:])
+    dtype = hdf5_file[keys[0]].dtype
+    source_stat = os.stat(input_hdf5_filepath)
+    metadata = {
+        "source_size": source_stat.st_size,
+        "source_mtime_ns": source_stat.st_mtime_ns,
+        "shape": list(shape),
+        "dtype": str(dtype),
+    }
+
+    if (
+        not cache_filepath.exists()
+        or not metadata_filepath.exists()
+        or json.loads(metadata_filepath.read_text()) != metadata
+    ):
+        print(f"Creating memmap cache {cache_filepath}")
+
+        def write_cache(tmp_filepath: pathlib.Path) -> None:
+            cache = np.lib.format.open_memmap(
+                tmp_filepath, mode="w+", dtype=dtype, shape=shape
+            )
+            for start in range(0, shape[0], chunk_size):
+                end = min(start + chunk_size, shape[0])
+                if len(keys) == 1:
+                    cache[start:end] = hdf5_file[keys[0]][start:end]
+                else:
+                    cache[start:end] = np.stack(
+                        [hdf5_file[key][start:end] for key in keys], axis=-3
+                    )
+            cache.flush()
+            del cache
+
+        _write_file_atomically(cache_filepath, write_cache)
+        _write_file_atomically(
+            metadata_filepath, lambda path: path.write_text(json.dumps(metadata))
+        )
+
+    # Copy-on-write mapping: pages are shared and the file is never modified
+    cache = np.load(cache_filepath, mmap_mode="c")
+    assert_equals(cache.shape, tuple(shape))
+    return torch.from_numpy(cache)
+
+
+class BatchedSubset(Subset):
+    # Subset only forwards __getitems__ from torch 2.1; without it the DataLoader falls back to
+    # per-index __getitem__ and the datasets' batched HDF5 reads never run
+    def __getitems__(self, idxs: List[int]) -> List[tuple]:
+        return self.dataset.__getitems__([int(self.indices[i]) for i in idxs])
+
+
 class NeRFGrid_To_GraspSuccess_HDF5_Dataset(Dataset):
     def __init__(
         self,
@@ -24,7 +125,6 @@ class NeRFGrid_To_GraspSuccess_HDF5_Dataset(Dataset):
         fingertip_config: BaseFingertipConfig,
         max_num_data_points: Optional[int] = None,
         load_nerf_densities_in_ram: bool = False,
-        load_grasp_labels_in_ram: bool = True,
         load_grasp_transforms_in_ram: bool = True,
         load_nerf_configs_in_ram: bool = True,
         load_grasp_configs_in_ram: bool = True,
@@ -66,29 +166,28 @@ class NeRFGrid_To_GraspSuccess_HDF5_Dataset(Dataset):
                 hdf5_file["/grasp_configs"].shape[1:], (self.NUM_FINGERS, 7 + 16 + 4)
             )
 
-            # This is usually too big for RAM
+            # This is usually too big for RAM, so memory-map it (shared across workers)
+            # Keep the stored dtype (may be float16) and upcast per datapoint
             self.nerf_densities = (
-                torch.from_numpy(hdf5_file["/nerf_densities"][()]).float()
+                load_hdf5_datasets_as_memmap(
+                    hdf5_file=hdf5_file,
+                    input_hdf5_filepath=self.input_hdf5_filepath,
+                    keys=["/nerf_densities"],
+                )
                 if load_nerf_densities_in_ram
                 else None
             )
 
-            # This is small enough to fit in RAM
-            self.passed_simulations = (
-                torch.from_numpy(hdf5_file["/passed_simulation"][()]).float()
-                if load_grasp_labels_in_ram
-                else None
-            )
-            self.passed_penetration_thresholds = (
-                torch.from_numpy(hdf5_file["/passed_penetration_threshold"][()]).float()
-                if load_grasp_labels_in_ram
-                else None
+            # These are tiny, so always keep them in RAM as float classes (N,) -> (N, 2)
+            # instead of doing a scalar HDF5 read and stack per datapoint
+            # TODO: Consider thresholding passed_X labels to be 0 or 1
+            self.passed_simulations = self._load_labels_as_classes(
+                hdf5_file, "/passed_simulation"
             )
-            self.passed_evals = (
-                torch.from_numpy(hdf5_file["/passed_eval"][()]).float()
-                if load_grasp_labels_in_ram
-                else None
+            self.passed_penetration_thresholds = self._load_labels_as_classes(
+                hdf5_file, "/passed_penetration_threshold"
             )
+            self.passed_evals = self._load_labels_as_classes(hdf5_file, "/passed_eval")
 
             # This is small enough to fit in RAM
             self.grasp_transforms = (
@@ -133,61 +232,42 @@ class NeRFGrid_To_GraspSuccess_HDF5_Dataset(Dataset):
 
         return length
 
+    @staticmethod
+    def _load_labels_as_classes(hdf5_file: h5py.File, key: str) -> torch.Tensor:
+        labels = torch.from_numpy(hdf5_file[key][()]).float()
+        assert_equals(len(labels.shape), 1)
+        return torch.stack([1 - labels, labels], dim=-1)
+
+    def _open_hdf5_file(self, rdcc_nbytes: int = HDF5_RDCC_NBYTES) -> h5py.File:
+        # Hope to speed up with rdcc params
+        # Each dataloader worker should get a share of the cache budget, not the full amount
+        return h5py.File(
+            self.input_hdf5_filepath,
+            "r",
+            rdcc_nbytes=rdcc_nbytes,
+            rdcc_w0=0.75,
+            rdcc_nslots=get_rdcc_nslots(rdcc_nbytes),
+        )
+
     def __len__(self) -> int:
         return self.len
 
     def __getitem__(self, idx: int):
         if self.hdf5_file is None:
-            # Hope to speed up with rdcc params
-            self.hdf5_file = h5py.File(
-                self.input_hdf5_filepath,
-                "r",
-                rdcc_nbytes=1024**2 * 4_000,
-                rdcc_w0=0.75,
-                rdcc_nslots=4_000,
-            )
+            self.hdf5_file = self._open_hdf5_file()
 
         nerf_densities = (
             torch.from_numpy(self.hdf5_file["/nerf_densities"][idx]).float()
             if self.nerf_densities is None
-            else self.nerf_densities[idx]
+            else self.nerf_densities[idx].float()
         )
 
-        passed_simulation = (
-            torch.from_numpy(
-                np.array(self.hdf5_file["/passed_simulation"][idx])
-            ).float()
-            if self.passed_simulations is None
-            else self.passed_simulations[idx]
-        )
-        passed_penetration_threshold = (
-            torch.from_numpy(
-                np.array(self.hdf5_file["/passed_penetration_threshold"][idx])
-            ).float()
-            if self.passed_penetration_thresholds is None
-            else self.passed_penetration_thresholds[idx]
-        )
-        passed_eval = (
-            torch.from_numpy(np.array(self.hdf5_file["/passed_eval"][idx])).float()
-            if self.passed_evals is None
-            else self.passed_evals[idx]
-        )
-        assert_equals(passed_simulation.shape, ())
-        assert_equals(passed_penetration_threshold.shape, ())
-        assert_equals(passed_eval.shape, ())
-
-        # TODO: Consider thresholding passed_X labels to be 0 or 1
-        # Convert to float classes (N,) -> (N, 2)
-        passed_simulation = torch.stack(
-            [1 - passed_simulation, passed_simulation], dim=-1
-        )
-        passed_penetration_threshold = torch.stack(
-            [1 - passed_penetration_threshold, passed_penetration_threshold], dim=-1
-        )
-        passed_eval = torch.stack([1 - passed_eval, passed_eval], dim=-1)
+        passed_simulation = self.passed_simulations[idx]
+        passed_penetration_threshold = self.passed_penetration_thresholds[idx]
+        passed_eval = self.passed_evals[idx]
 
         grasp_transforms = (
-            torch.from_numpy(np.array(self.hdf5_file["/grasp_transforms"][idx])).float()
+            torch.from_numpy(self.hdf5_file["/grasp_transforms"][idx]).float()
             if self.grasp_transforms is None
             else self.grasp_transforms[idx]
         )
@@ -199,7 +279,7 @@ class NeRFGrid_To_GraspSuccess_HDF5_Dataset(Dataset):
         ).decode("utf-8")
 
         grasp_configs = (
-            torch.from_numpy(np.array(self.hdf5_file["/grasp_configs"][idx])).float()
+            torch.from_numpy(self.hdf5_file["/grasp_configs"][idx]).float()
             if self.grasp_configs is None
             else self.grasp_configs[idx]
         )
@@ -225,6 +305,81 @@ class NeRFGrid_To_GraspSuccess_HDF5_Dataset(Dataset):
             grasp_configs,
         )
 
+    def __getitems__(self, idxs: List[int]) -> List[tuple]:
+        # Called by the DataLoader once per batch instead of __getitem__ per index,
+        # so each HDF5 dataset is hit with one multi-index read rather than batch_size small ones
+        if self.hdf5_file is None:
+            self.hdf5_file = self._open_hdf5_file()
+
+        # h5py fancy indexing needs sorted, unique indices, so read those and then undo the sort
+        idxs = np.asarray(idxs)
+        sorted_idxs, unsort = np.unique(idxs, return_inverse=True)
+
+        def read(key: str) -> np.ndarray:
+            return self.hdf5_file[key][sorted_idxs][unsort]
+
+        nerf_densities = (
+            torch.from_numpy(read("/nerf_densities")).float()
+            if self.nerf_densities is None
+            else self.nerf_densities[idxs].float()
+        )
+
+        passed_simulations = self.passed_simulations[idxs]
+        passed_penetration_thresholds = self.passed_penetration_thresholds[idxs]
+        passed_evals = self.passed_evals[idxs]
+
+        grasp_transforms = (
+            torch.from_numpy(read("/grasp_transforms")).float()
+            if self.grasp_transforms is None
+            else self.grasp_transforms[idxs]
+        )
+
+        nerf_configs = [
+            nerf_config.decode("utf-8")
+            for nerf_config in (
+                read("/nerf_config")
+                if self.nerf_configs is None
+                else self.nerf_configs[idxs]
+            )
+        ]
+
+        grasp_configs = (
+            torch.from_numpy(read("/grasp_configs")).float()
+            if self.grasp_configs is None
+            else self.grasp_configs[idxs]
+        )
+
+        batch_size = len(idxs)
+        assert_equals(
+            nerf_densities.shape,
+            (
+                batch_size,
+                self.NUM_FINGERS,
+                self.NUM_PTS_X,
+                self.NUM_PTS_Y,
+                self.NUM_PTS_Z,
+            ),
+        )
+        NUM_CLASSES = 2
+        assert_equals(passed_simulations.shape, (batch_size, NUM_CLASSES))
+        assert_equals(passed_penetration_thresholds.shape, (batch_size, NUM_CLASSES))
+        assert_equals(passed_evals.shape, (batch_size, NUM_CLASSES))
+        assert_equals(grasp_transforms.shape, (batch_size, self.NUM_FINGERS, 4, 4))
+        assert_equals(grasp_configs.shape, (batch_size, self.NUM_FINGERS, 7 + 16 + 4))
+
+        # Split back into per-datapoint samples (views, no copies) for the collate_fn
+        return list(
+            zip(
+                nerf_densities,
+                passed_simulations,
+                passed_penetration_thresholds,
+                passed_evals,
+                grasp_transforms,
+                nerf_configs,
+                grasp_configs,
+            )
+        )
+
     @property
     def NUM_FINGERS(self) -> int:
         return self.fingertip_config.n_fingers
@@ -251,7 +406,6 @@ class DepthImage_To_GraspSuccess_HDF5_Dataset(Dataset):
         fingertip_camera_config: CameraConfig,
         max_num_data_points: Optional[int] = None,
         load_depth_images_in_ram: bool = False,
-        load_grasp_labels_in_ram: bool = True,
         load_grasp_transforms_in_ram: bool = True,
         load_nerf_configs_in_ram: bool = True,
         load_grasp_configs_in_ram: bool = True,
@@ -301,35 +455,28 @@ class DepthImage_To_GraspSuccess_HDF5_Dataset(Dataset):
                 hdf5_file["/grasp_configs"].shape[1:], (self.NUM_FINGERS, 7 + 16 + 4)
             )
 
-            # This is usually too big for RAM
+            # This is usually too big for RAM, so memory-map it (shared across workers)
+            # Keep the stored dtype (may be float16) and upcast per datapoint
             self.depth_uncertainty_images = (
-                torch.stack(
-                    [
-                        torch.from_numpy(hdf5_file["/depth_images"][()]).float(),
-                        torch.from_numpy(hdf5_file["/uncertainty_images"][()]).float(),
-                    ],
-                    dim=-3,
+                load_hdf5_datasets_as_memmap(
+                    hdf5_file=hdf5_file,
+                    input_hdf5_filepath=self.input_hdf5_filepath,
+                    keys=["/depth_images", "/uncertainty_images"],
                 )
                 if load_depth_images_in_ram
                 else None
             )
 
-            # This is small enough to fit in RAM
-            self.passed_simulations = (
-                torch.from_numpy(hdf5_file["/passed_simulation"][()]).float()
-                if load_grasp_labels_in_ram
-                else None
+            # These are tiny, so always keep them in RAM as float classes (N,) -> (N, 2)
+            # instead of doing a scalar HDF5 read and stack per datapoint
+            # TODO: Consider thresholding passed_X labels to be 0 or 1
+            self.passed_simulations = self._load_labels_as_classes(
+                hdf5_file, "/passed_simulation"
             )
-            self.passed_penetration_thresholds = (
-                torch.from_numpy(hdf5_file["/passed_penetration_threshold"][()]).float()
-                if load_grasp_labels_in_ram
-                else None
-            )
-            self.passed_evals = (
-                torch.from_numpy(hdf5_file["/passed_eval"][()]).float()
-                if load_grasp_labels_in_ram
-                else None
+            self.passed_penetration_thresholds = self._load_labels_as_classes(
+                hdf5_file, "/passed_penetration_threshold"
             )
+            self.passed_evals = self._load_labels_as_classes(hdf5_file, "/passed_eval")
 
             # This is small enough to fit in RAM
             self.grasp_transforms = (
@@ -374,19 +521,29 @@ class DepthImage_To_GraspSuccess_HDF5_Dataset(Dataset):
 
         return length
 
+    @staticmethod
+    def _load_labels_as_classes(hdf5_file: h5py.File, key: str) -> torch.Tensor:
+        labels = torch.from_numpy(hdf5_file[key][()]).float()
+        assert_equals(len(labels.shape), 1)
+        return torch.stack([1 - labels, labels], dim=-1)
+
+    def _open_hdf5_file(self, rdcc_nbytes: int = HDF5_RDCC_NBYTES) -> h5py.File:
+        # Hope to speed up with rdcc params
+        # Each dataloader worker should get a share of the cache budget, not the full amount
+        return h5py.File(
+            self.input_hdf5_filepath,
+            "r",
+            rdcc_nbytes=rdcc_nbytes,
+            rdcc_w0=0.75,
+            rdcc_nslots=get_rdcc_nslots(rdcc_nbytes),
+        )
+
     def __len__(self) -> int:
         return self.len
 
     def __getitem__(self, idx: int):
         if self.hdf5_file is None:
-            # Hope to speed up with rdcc params
-            self.hdf5_file = h5py.File(
-                self.input_hdf5_filepath,
-                "r",
-                rdcc_nbytes=1024**2 * 4_000,
-                rdcc_w0=0.75,
-                rdcc_nslots=4_000,
-            )
+            self.hdf5_file = self._open_hdf5_file()
 
         depth_uncertainty_images = (
             torch.stack(
@@ -399,44 +556,15 @@ class DepthImage_To_GraspSuccess_HDF5_Dataset(Dataset):
                 dim=-3,
             )
             if self.depth_uncertainty_images is None
-            else self.depth_uncertainty_images[idx]
+            else self.depth_uncertainty_images[idx].float()
         )
 
-        passed_simulation = (
-            torch.from_numpy(
-                np.array(self.hdf5_file["/passed_simulation"][idx])
-            ).float()
-            if self.passed_simulations is None
-            else self.passed_simulations[idx]
-        )
-        passed_penetration_threshold = (
-            torch.from_numpy(
-                np.array(self.hdf5_file["/passed_penetration_threshold"][idx])
-            ).float()
-            if self.passed_penetration_thresholds is None
-            else self.passed_penetration_thresholds[idx]
-        )
-        passed_eval = (
-            torch.from_numpy(np.array(self.hdf5_file["/passed_eval"][idx])).float()
-            if self.passed_evals is None
-            else self.passed_evals[idx]
-        )
-        assert_equals(passed_simulation.shape, ())
-        assert_equals(passed_penetration_threshold.shape, ())
-        assert_equals(passed_eval.shape, ())
-
-        # TODO: Consider thresholding passed_X labels to be 0 or 1
-        # Convert to float classes (N,) -> (N, 2)
-        passed_simulation = torch.stack(
-            [1 - passed_simulation, passed_simulation], dim=-1
-        )
-        passed_penetration_threshold = torch.stack(
-            [1 - passed_penetration_threshold, passed_penetration_threshold], dim=-1
-        )
-        passed_eval = torch.stack([1 - passed_eval, passed_eval], dim=-1)
+        passed_simulation = self.passed_simulations[idx]
+        passed_penetration_threshold = self.passed_penetration_thresholds[idx]
+        passed_eval = self.passed_evals[idx]
 
         grasp_transforms = (
-            torch.from_numpy(np.array(self.hdf5_file["/grasp_transforms"][idx])).float()
+            torch.from_numpy(self.hdf5_file["/grasp_transforms"][idx]).float()
             if self.grasp_transforms is None
             else self.grasp_transforms[idx]
         )
@@ -448,7 +576,7 @@ class DepthImage_To_GraspSuccess_HDF5_Dataset(Dataset):
         ).decode("utf-8")
 
         grasp_configs = (
-            torch.from_numpy(np.array(self.hdf5_file["/grasp_configs"][idx])).float()
+            torch.from_numpy(self.hdf5_file["/grasp_configs"][idx]).float()
             if self.grasp_configs is None
             else self.grasp_configs[idx]
         )
@@ -479,6 +607,87 @@ class DepthImage_To_GraspSuccess_HDF5_Dataset(Dataset):
             grasp_configs,
         )
 
+    def __getitems__(self, idxs: List[int]) -> List[tuple]:
+        # Called by the DataLoader once per batch instead of __getitem__ per index,
+        # so each HDF5 dataset is hit with one multi-index read rather than batch_size small ones
+        if self.hdf5_file is None:
+            self.hdf5_file = self._open_hdf5_file()
+
+        # h5py fancy indexing needs sorted, unique indices, so read those and then undo the sort
+        idxs = np.asarray(idxs)
+        sorted_idxs, unsort = np.unique(idxs, return_inverse=True)
+
+        def read(key: str) -> np.ndarray:
+            return self.hdf5_file[key][sorted_idxs][unsort]
+
+        depth_uncertainty_images = (
+            torch.stack(
+                [
+                    torch.from_numpy(read("/depth_images")).float(),
+                    torch.from_numpy(read("/uncertainty_images")).float(),
+                ],
+                dim=-3,
+            )
+            if self.depth_uncertainty_images is None
+            else self.depth_uncertainty_images[idxs].float()
+        )
+
+        passed_simulations = self.passed_simulations[idxs]
+        passed_penetration_thresholds = self.passed_penetration_thresholds[idxs]
+        passed_evals = self.passed_evals[idxs]
+
+        grasp_transforms = (
+            torch.from_numpy(read("/grasp_transforms")).float()
+            if self.grasp_transforms is None
+            else self.grasp_transforms[idxs]
+        )
+
+        nerf_configs = [
+            nerf_config.decode("utf-8")
+            for nerf_config in (
+                read("/nerf_config")
+                if self.nerf_configs is None
+                else self.nerf_configs[idxs]
+            )
+        ]
+
+        grasp_configs = (
+            torch.from_numpy(read("/grasp_configs")).float()
+            if self.grasp_configs is None
+            else self.grasp_configs[idxs]
+        )
+
+        batch_size = len(idxs)
+        assert_equals(
+            depth_uncertainty_images.shape,
+            (
+                batch_size,
+                self.NUM_FINGERS,
+                self.DEPTH_IMAGE_N_CHANNELS,
+                self.DEPTH_IMAGE_HEIGHT,
+                self.DEPTH_IMAGE_WIDTH,
+            ),
+        )
+        NUM_CLASSES = 2
+        assert_equals(passed_simulations.shape, (batch_size, NUM_CLASSES))
+        assert_equals(passed_penetration_thresholds.shape, (batch_size, NUM_CLASSES))
+        assert_equals(passed_evals.shape, (batch_size, NUM_CLASSES))
+        assert_equals(grasp_transforms.shape, (batch_size, self.NUM_FINGERS, 4, 4))
+        assert_equals(grasp_configs.shape, (batch_size, self.NUM_FINGERS, 7 + 16 + 4))
+
+        # Split back into per-datapoint samples (views, no copies) for the collate_fn
+        return list(
+            zip(
+                depth_uncertainty_images,
+                passed_simulations,
+                passed_penetration_thresholds,
+                passed_evals,
+                grasp_transforms,
+                nerf_configs,
+                grasp_configs,
+            )
+        )
+
     @property
     def NUM_FINGERS(self) -> int:
         return self.fingertip_config.n_fingers
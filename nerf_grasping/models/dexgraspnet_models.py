@@ -1,5 +1,6 @@
 import torch
 import torch.nn as nn
+import torch.utils.checkpoint
 from typing import Tuple, Optional, List
 from functools import lru_cache
 from nerf_grasping.models.tyler_new_models import (
@@ -28,12 +29,14 @@ class CNN_3D_Model(nn.Module):
         n_fingers: int,
         n_tasks: int = 1,
         n_classes: int = 2,
+        grad_checkpointing: bool = False,
     ) -> None:
         super().__init__()
         self.input_shape = input_shape
         self.n_fingers = n_fingers
         self.n_tasks = n_tasks
         self.n_classes = n_classes
+        self.grad_checkpointing = grad_checkpointing
 
         self.conv = conv_encoder(
             input_shape=self.input_shape,
@@ -67,6 +70,9 @@ class CNN_3D_Model(nn.Module):
             hidden_layers=mlp_hidden_layers,
         )
 
+        # NDHWC layout lets cuDNN pick its faster channels-last Conv3d kernels
+        self.conv = self.conv.to(memory_format=torch.channels_last_3d)
+
     def forward(self, x: torch.Tensor) -> torch.Tensor:
         batch_size = x.shape[0]
         assert_equals(
@@ -79,9 +85,21 @@ class CNN_3D_Model(nn.Module):
         )
 
         # Put n_fingers into batch dim
-        x = x.reshape(batch_size * self.n_fingers, *self.input_shape)
-
-        x = self.conv(x)
+        # No-op copy if the input is already laid out channels-last (see BatchDataInput)
+        x = x.reshape(batch_size * self.n_fingers, *self.input_shape).contiguous(
+            memory_format=torch.channels_last_3d
+        )
+
+        if self.grad_checkpointing and self.training and torch.is_grad_enabled():
+            # Recompute Conv3d activations in backward instead of storing them
+            x = torch.utils.checkpoint.checkpoint_sequential(
+                self.conv,
+                segments=min(4, len(self.conv)),
+                input=x,
+                use_reentrant=False,
+            )
+        else:
+            x = self.conv(x)
         assert_equals(
             x.shape,
             (
@@ -1,6 +1,6 @@
 import torch
 import torch.nn as nn
-from typing import List, Tuple, Optional, Dict, Any, Union
+from typing import List, Tuple, Optional, Dict, Any, Union, NamedTuple, Type
 from dataclasses import dataclass, field
 from nerf_grasping.models.FiLM_resnet import (
     resnet18,
@@ -137,6 +137,45 @@ CONV_1D_OUTPUT_TO_1D_MAP = {
 }
 
 
+class ConvLayerTypes(NamedTuple):
+    conv: Type[nn.Module]
+    max_pool: Type[nn.Module]
+    avg_pool: Type[nn.Module]
+    dropout: Optional[Type[nn.Module]]
+    adaptive_max_pool: Type[nn.Module]
+    adaptive_avg_pool: Type[nn.Module]
+
+
+# Indexed by n_spatial_dims - 1
+# adaptive_avg_pool has always resolved to the max variant, kept so trained models match
+CONV_LAYER_TYPES_TABLE = (
+    ConvLayerTypes(
+        conv=nn.Conv1d,
+        max_pool=nn.MaxPool1d,
+        avg_pool=nn.AvgPool1d,
+        dropout=None,  # nn.Dropout1d is not in some versions of torch
+        adaptive_max_pool=nn.AdaptiveMaxPool1d,
+        adaptive_avg_pool=nn.AdaptiveMaxPool1d,
+    ),
+    ConvLayerTypes(
+        conv=nn.Conv2d,
+        max_pool=nn.MaxPool2d,
+        avg_pool=nn.AvgPool2d,
+        dropout=nn.Dropout2d,
+        adaptive_max_pool=nn.AdaptiveMaxPool2d,
+        adaptive_avg_pool=nn.AdaptiveMaxPool2d,
+    ),
+    ConvLayerTypes(
+        conv=nn.Conv3d,
+        max_pool=nn.MaxPool3d,
+        avg_pool=nn.AvgPool3d,
+        dropout=nn.Dropout3d,
+        adaptive_max_pool=nn.AdaptiveMaxPool3d,
+        adaptive_avg_pool=nn.AdaptiveMaxPool3d,
+    ),
+)
+
+
 ### HELPER FUNCTIONS ###
 def mlp(
     num_inputs: int,
@@ -168,43 +207,17 @@ def conv_encoder(
     n_input_channels = input_shape[0]
     n_spatial_dims = len(input_shape[1:])
 
-    # Layers for different input sizes
-    n_spatial_dims_to_conv_layer_map = {1: nn.Conv1d, 2: nn.Conv2d, 3: nn.Conv3d}
-    n_spatial_dims_to_maxpool_layer_map = {
-        1: nn.MaxPool1d,
-        2: nn.MaxPool2d,
-        3: nn.MaxPool3d,
-    }
-    n_spatial_dims_to_avgpool_layer_map = {
-        1: nn.AvgPool1d,
-        2: nn.AvgPool2d,
-        3: nn.AvgPool3d,
-    }
-    n_spatial_dims_to_dropout_layer_map = {
-        # 1: nn.Dropout1d,  # Not in some versions of torch
-        2: nn.Dropout2d,
-        3: nn.Dropout3d,
-    }
-    n_spatial_dims_to_adaptivemaxpool_layer_map = {
-        1: nn.AdaptiveMaxPool1d,
-        2: nn.AdaptiveMaxPool2d,
-        3: nn.AdaptiveMaxPool3d,
-    }
-    n_spatial_dims_to_adaptiveavgpool_layer_map = {
-        1: nn.AdaptiveMaxPool1d,
-        2: nn.AdaptiveMaxPool2d,
-        3: nn.AdaptiveMaxPool3d,
-    }
-
     # Setup layer types
-    conv_layer = n_spatial_dims_to_conv_layer_map[n_spatial_dims]
+    layer_types = CONV_LAYER_TYPES_TABLE[n_spatial_dims - 1]
+    conv_layer = layer_types.conv
     if pool_type == PoolType.MAX:
-        pool_layer = n_spatial_dims_to_maxpool_layer_map[n_spatial_dims]
+        pool_layer = layer_types.max_pool
     elif pool_type == PoolType.AVG:
-        pool_layer = n_spatial_dims_to_avgpool_layer_map[n_spatial_dims]
+        pool_layer = layer_types.avg_pool
     else:
         raise ValueError(f"Invalid pool_type = {pool_type}")
-    dropout_layer = n_spatial_dims_to_dropout_layer_map[n_spatial_dims]
+    dropout_layer = layer_types.dropout
+    assert dropout_prob == 0.0 or dropout_layer is not None
 
     # Conv layers
     layers = []
@@ -228,17 +241,13 @@ def conv_encoder(
     if conv_output_to_1d == ConvOutputTo1D.FLATTEN:
         layers.append(nn.Flatten(start_dim=1))
     elif conv_output_to_1d == ConvOutputTo1D.AVG_POOL_SPATIAL:
-        adaptiveavgpool_layer = n_spatial_dims_to_adaptiveavgpool_layer_map[
-            n_spatial_dims
-        ]
+        adaptiveavgpool_layer = layer_types.adaptive_avg_pool
         layers.append(
             adaptiveavgpool_layer(output_size=tuple([1 for _ in range(n_spatial_dims)]))
         )
         layers.append(nn.Flatten(start_dim=1))
     elif conv_output_to_1d == ConvOutputTo1D.MAX_POOL_SPATIAL:
-        adaptivemaxpool_layer = n_spatial_dims_to_adaptivemaxpool_layer_map[
-            n_spatial_dims
-        ]
+        adaptivemaxpool_layer = layer_types.adaptive_max_pool
         layers.append(
             adaptivemaxpool_layer(output_size=tuple([1 for _ in range(n_spatial_dims)]))
         )
@@ -408,6 +417,9 @@ class ConvEncoder2D(nn.Module):
         self.conv_2d.avgpool = CONV_2D_OUTPUT_TO_1D_MAP[self.pooling_method]()
         self.conv_2d.fc = nn.Identity()
 
+        # NHWC layout lets cuDNN pick its faster channels-last Conv2d kernels
+        self.conv_2d = self.conv_2d.to(memory_format=torch.channels_last)
+
         # Create FiLM generator
         if self.conditioning_dim is not None and self.num_film_params is not None:
             self.film_generator = FiLMGenerator(
@@ -442,7 +454,7 @@ class ConvEncoder2D(nn.Module):
             beta, gamma = None, None
 
         # Conv
-        x = self.img_preprocess(x)
+        x = self.img_preprocess(x).contiguous(memory_format=torch.channels_last)
         x = self.conv_2d(x, beta=beta, gamma=gamma)
         assert len(x.shape) == 2 and x.shape[0] == batch_size
 
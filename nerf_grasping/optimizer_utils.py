@@ -727,9 +727,8 @@ class GraspMetric(torch.nn.Module):
             ), f"Requested checkpoint {classifier_checkpoint} does not exist in {classifier_config.checkpoint_workspace.output_checkpoint_paths}"
             checkpoint_path = output_checkpoint_paths[classifier_checkpoint]
 
-            checkpoint = torch.load(checkpoint_path)
+            checkpoint = torch.load(checkpoint_path, map_location="cpu")
             classifier.load_state_dict(checkpoint["classifier"])
-            classifier.load_state_dict(torch.load(checkpoint_path)["classifier"])
 
             if progress is not None and task is not None:
                 progress.update(task, advance=1)
@@ -923,9 +922,8 @@ class DepthImageGraspMetric(torch.nn.Module):
             ), f"Requested checkpoint {classifier_checkpoint} does not exist in {classifier_config.checkpoint_workspace.output_checkpoint_paths}"
             checkpoint_path = output_checkpoint_paths[classifier_checkpoint]
 
-            checkpoint = torch.load(checkpoint_path)
+            checkpoint = torch.load(checkpoint_path, map_location="cpu")
             classifier.load_state_dict(checkpoint["classifier"])
-            classifier.load_state_dict(torch.load(checkpoint_path)["classifier"])
 
             if progress is not None and task is not None:
                 progress.update(task, advance=1)
@@ -0,0 +1,69 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+pp = pytest.importorskip("pypose")
+pytest.importorskip("nerfstudio")
+
+from nerf_grasping.config.fingertip_config import EvenlySpacedFingertipConfig
+from nerf_grasping.learned_metric.DexGraspNet_batch_data import (
+    BatchData,
+    BatchDataInput,
+    BatchDataOutput,
+)
+
+
+def make_batch_data(batch_size: int = 3) -> BatchData:
+    fingertip_config = EvenlySpacedFingertipConfig()
+    n_fingers = fingertip_config.n_fingers
+    wrist_poses = pp.randn_SE3(batch_size, n_fingers).tensor()
+    joint_angles = torch.randn(batch_size, n_fingers, 16)
+    grasp_orientations = pp.randn_SO3(batch_size, n_fingers).tensor()
+    return BatchData(
+        input=BatchDataInput(
+            nerf_densities=torch.rand(
+                batch_size,
+                n_fingers,
+                fingertip_config.num_pts_x,
+                fingertip_config.num_pts_y,
+                fingertip_config.num_pts_z,
+            ),
+            grasp_transforms=pp.randn_SE3(batch_size, n_fingers),
+            fingertip_config=fingertip_config,
+            grasp_configs=torch.cat(
+                (wrist_poses, joint_angles, grasp_orientations), dim=-1
+            ),
+            random_rotate_transform=pp.randn_SE3(batch_size),
+        ),
+        output=BatchDataOutput(
+            passed_simulation=torch.rand(batch_size, 2),
+            passed_penetration_threshold=torch.rand(batch_size, 2),
+            passed_eval=torch.rand(batch_size, 2),
+        ),
+        nerf_config=["nerf_config.yml"] * batch_size,
+    )
+
+
+@pytest.mark.skipif(not torch.cuda.is_available(), reason="pinning needs CUDA")
+def test_pin_memory_keeps_lie_tensors() -> None:
+    batch_data = make_batch_data()
+    expected_grasp_configs = batch_data.input.augmented_grasp_configs
+    expected_grasp_transforms = batch_data.input.augmented_grasp_transforms.tensor()
+
+    batch_data = batch_data.pin_memory()
+    assert isinstance(batch_data.input.grasp_transforms, pp.LieTensor)
+    assert isinstance(batch_data.input.random_rotate_transform, pp.LieTensor)
+    assert batch_data.input.grasp_transforms.ltype == pp.SE3_type
+    assert batch_data.input.random_rotate_transform.ltype == pp.SE3_type
+    assert batch_data.input.nerf_densities.is_pinned()
+    assert batch_data.input.grasp_transforms.is_pinned()
+    assert batch_data.input.random_rotate_transform.is_pinned()
+
+    batch_data = batch_data.to(torch.device("cuda"), non_blocking=True)
+    torch.cuda.synchronize()
+    torch.testing.assert_close(
+        batch_data.input.augmented_grasp_configs.cpu(), expected_grasp_configs
+    )
+    torch.testing.assert_close(
+        batch_data.input.augmented_grasp_transforms.tensor().cpu(),
+        expected_grasp_transforms,
+    )